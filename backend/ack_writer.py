@@ -0,0 +1,138 @@
+import asyncio
+import logging
+from collections import Counter
+from datetime import datetime
+from typing import Any, Dict, Optional, Set, Tuple
+
+from sqlalchemy import bindparam, func
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlmodel.ext.asyncio.session import AsyncSession
+from database import async_engine
+from models import MachineSoftwareLink
+
+logger = logging.getLogger(__name__)
+
+# Task acks are collected here and written every fraction of a second as one executemany upsert
+# and one commit, instead of a transaction per ack. Several acks for the same link in one batch
+# collapse into the newest.
+ACK_FLUSH_INTERVAL_SECONDS = 0.2
+
+# One INSERT ... ON CONFLICT on the (machine_id, software_id) primary key.
+# A NULL installed_version (uninstall, failure) keeps whatever version was recorded before.
+_link_insert = sqlite_insert(MachineSoftwareLink).values(
+    machine_id=bindparam("machine_id"),
+    software_id=bindparam("software_id"),
+    status=bindparam("status"),
+    installed_version=bindparam("installed_version"),
+    last_updated=bindparam("last_updated"),
+)
+LINK_UPSERT = _link_insert.on_conflict_do_update(
+    index_elements=[MachineSoftwareLink.machine_id, MachineSoftwareLink.software_id],
+    set_={
+        "status": _link_insert.excluded.status,
+        "installed_version": func.coalesce(_link_insert.excluded.installed_version, MachineSoftwareLink.installed_version),
+        "last_updated": _link_insert.excluded.last_updated,
+    },
+)
+
+_pending: Dict[Tuple[int, int], Dict[str, Any]] = {}
+# Queued links per machine, so a heartbeat's has_pending check doesn't scan _pending
+_pending_machines = Counter()
+# Machines whose acks were taken by a flush that hasn't committed yet
+_in_flight: Set[int] = set()
+_flush_lock: Optional[asyncio.Lock] = None
+_writer: Optional[asyncio.Task] = None
+_stopping: Optional[asyncio.Event] = None
+
+def record(machine_id: int, software_id: int, status: str, installed_version: Optional[str], last_updated: datetime) -> bool:
+    """Schedule a link upsert. False if the writer isn't running and the caller should write it itself."""
+    if _writer is None:
+        return False
+    key = (machine_id, software_id)
+    previous = _pending.get(key)
+    if previous is None:
+        _pending_machines[machine_id] += 1
+    elif installed_version is None:
+        # Same as two upserts in a row: a NULL version keeps the one before it
+        installed_version = previous["installed_version"]
+    _pending[key] = {
+        "machine_id": machine_id,
+        "software_id": software_id,
+        "status": status,
+        "installed_version": installed_version,
+        "last_updated": last_updated,
+    }
+    return True
+
+def has_pending(machine_id: int) -> bool:
+    """True while an ack of this machine is queued or being written."""
+    return machine_id in _in_flight or _pending_machines[machine_id] > 0
+
+def _requeue(rows):
+    """Put the rows of a failed write back; acks recorded since then are newer and win."""
+    for row in rows:
+        key = (row["machine_id"], row["software_id"])
+        newer = _pending.get(key)
+        if newer is None:
+            _pending[key] = row
+            _pending_machines[row["machine_id"]] += 1
+        elif newer["installed_version"] is None:
+            # The newer ack was applied on top of this one: its NULL version keeps this one's
+            newer["installed_version"] = row["installed_version"]
+
+async def flush():
+    """Write every queued ack. Returns once acks queued or in flight when called are committed (or queued again)."""
+    if _flush_lock is None:
+        return
+
+    # Serialized, so a caller waiting here also waits for a flush that already took its machine's rows
+    async with _flush_lock:
+        if not _pending:
+            return
+        rows = list(_pending.values())
+        _pending.clear()
+        _pending_machines.clear()
+        machine_ids = {row["machine_id"] for row in rows}
+        _in_flight.update(machine_ids)
+        try:
+            async with AsyncSession(async_engine) as session:
+                await session.exec(LINK_UPSERT, params=rows)
+                # Core statements don't go through the flush hooks; cached heartbeat candidates hold these links
+                session.info.setdefault("links_changed", set()).update(machine_ids)
+                await session.commit()
+        except Exception as e:
+            # The agents were already told these were acknowledged; losing them would resend the tasks
+            logger.error("Failed to write %d task acks, retrying with the next flush: %s", len(rows), e)
+            _requeue(rows)
+        finally:
+            _in_flight.difference_update(machine_ids)
+
+async def _run(stopping: asyncio.Event):
+    while not stopping.is_set():
+        try:
+            await asyncio.wait_for(stopping.wait(), ACK_FLUSH_INTERVAL_SECONDS)
+        except asyncio.TimeoutError:
+            pass
+        await flush()
+
+def start():
+    global _writer, _stopping, _flush_lock
+    if _writer is not None:
+        return
+    _flush_lock = asyncio.Lock()
+    _stopping = asyncio.Event()
+    _writer = asyncio.create_task(_run(_stopping))
+
+async def stop():
+    """Stop the writer after a final flush of the queued acks."""
+    global _writer, _stopping, _flush_lock
+    if _writer is None:
+        return
+    _stopping.set()
+    await _writer
+    _writer = _stopping = None
+    # Acks recorded while the last flush was running
+    await flush()
+    if _pending:
+        logger.error("Shutting down with %d task acks unwritten", len(_pending))
+    _flush_lock = None
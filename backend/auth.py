@@ -1,38 +1,130 @@
-from datetime import datetime, timedelta, timezone
+from datetime import timedelta
 from typing import Optional
+from functools import lru_cache
+import hashlib
+import logging
+import threading
+import time
 import jwt
-from passlib.context import CryptContext
+import bcrypt
+import orjson
+from cachetools import TTLCache
 from fastapi import Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordBearer, APIKeyHeader
+from sqlalchemy import bindparam
 from sqlmodel import Session, select
 import secrets
 from config import settings
 from database import get_session
 from models import Admin
 
+logger = logging.getLogger(__name__)
+
 # Configuration
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 30
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+# bcrypt cost tuning
+BCRYPT_TARGET_SECONDS = 0.25
+BCRYPT_MIN_ROUNDS = 4
+BCRYPT_MAX_ROUNDS = 14
+
+def _calibrate_bcrypt_rounds() -> int:
+    """Find the lowest cost whose hash takes at least BCRYPT_TARGET_SECONDS on this host."""
+    probe = secrets.token_bytes(16)
+    rounds = BCRYPT_MIN_ROUNDS
+    while rounds < BCRYPT_MAX_ROUNDS:
+        start = time.perf_counter()
+        bcrypt.hashpw(probe, bcrypt.gensalt(rounds=rounds))
+        if time.perf_counter() - start >= BCRYPT_TARGET_SECONDS:
+            break
+        rounds += 1
+    return rounds
+
+def _resolve_bcrypt_rounds() -> int:
+    if settings.BCRYPT_COST:
+        return settings.BCRYPT_COST
+
+    if settings.USE_MOCK_LDAP:
+        # Dev/Mock: minimum cost keeps logins and test setup fast
+        return BCRYPT_MIN_ROUNDS
+
+    rounds = _calibrate_bcrypt_rounds()
+    settings.BCRYPT_COST = rounds
+    settings._save_secret("BCRYPT_COST", str(rounds))
+    logger.info("Calibrated bcrypt cost to %d for this host. Saved as BCRYPT_COST.", rounds)
+    return rounds
+
+BCRYPT_ROUNDS = _resolve_bcrypt_rounds()
+
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/api/v1/auth/token")
 api_key_header = APIKeyHeader(name="X-Agent-Token", auto_error=False)
 
-def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
-    to_encode = data.copy()
-    if expires_delta:
-        expire = datetime.now(timezone.utc) + expires_delta
-    else:
-        expire = datetime.now(timezone.utc) + timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
-    to_encode.update({"exp": expire})
-    encoded_jwt = jwt.encode(to_encode, settings.SECRET_KEY, algorithm=ALGORITHM)
+# Verified token cache: blake2b-128(token) digest -> (exp, detached Admin snapshot)
+# Raw tokens are never stored. Entries live at most JWT_CACHE_TTL_SECONDS and never past the token's own exp.
+_token_cache = TTLCache(maxsize=settings.JWT_CACHE_MAX, ttl=settings.JWT_CACHE_TTL_SECONDS)
+# Detached Admin snapshots by username, shared by all tokens of the same admin
+_admin_cache = TTLCache(maxsize=1024, ttl=60)
+_auth_cache_lock = threading.Lock()
+
+class _OrjsonJWT(jwt.PyJWT):
+    """PyJWT with claim (de)serialization done by orjson instead of stdlib json."""
+
+    def _encode_payload(self, payload, headers=None, json_encoder=None):
+        if json_encoder is not None:
+            return super()._encode_payload(payload, headers, json_encoder)
+        return orjson.dumps(payload)
+
+    def _decode_payload(self, decoded):
+        try:
+            payload = orjson.loads(decoded["payload"])
+        except orjson.JSONDecodeError as e:
+            raise jwt.DecodeError(f"Invalid payload string: {e}") from e
+        if not isinstance(payload, dict):
+            raise jwt.DecodeError("Invalid payload string: must be a json object")
+        return payload
+
+_jwt = _OrjsonJWT()
+
+# Admin lookup by the unique username index, built once so SQLAlchemy reuses its compiled form
+ADMIN_BY_USERNAME = select(Admin).where(Admin.username == bindparam("username"))
+
+# jwt.decode arguments built once instead of per request
+_JWT_DECODE_KWARGS = {
+    "key": settings.SECRET_KEY_BYTES,
+    "algorithms": [ALGORITHM],
+    "options": {"require": ["exp", "sub"]},
+}
+
+def create_access_token(data: Optional[dict] = None, expires_delta: Optional[timedelta] = None, **claims):
+    # Keyword claims already arrive as a fresh dict we own; only a caller's dict needs copying
+    to_encode = {**data, **claims} if data else claims
+    lifetime = expires_delta.total_seconds() if expires_delta else ACCESS_TOKEN_EXPIRE_MINUTES * 60
+    # Integer epoch seconds, which is what PyJWT would convert a datetime to anyway
+    to_encode["exp"] = int(time.time() + lifetime)
+    encoded_jwt = _jwt.encode(to_encode, settings.SECRET_KEY_BYTES, algorithm=ALGORITHM)
     return encoded_jwt
 
 def verify_password(plain_password, hashed_password):
-    return pwd_context.verify(plain_password, hashed_password)
+    # Raises ValueError on a malformed hash, same as passlib did
+    return bcrypt.checkpw(plain_password.encode(), hashed_password.encode())
+
+def _hash_password(password, rounds):
+    return bcrypt.hashpw(password.encode(), bcrypt.gensalt(rounds=rounds)).decode()
+
+# Dev/Mock only: the same seed and test passwords are hashed once per process
+_cached_password_hash = lru_cache(maxsize=64)(_hash_password)
 
 def get_password_hash(password):
-    return pwd_context.hash(password)
+    if settings.USE_MOCK_LDAP:
+        # Production never memoizes plaintext passwords
+        return _cached_password_hash(password, BCRYPT_ROUNDS)
+    return _hash_password(password, BCRYPT_ROUNDS)
+
+@lru_cache(maxsize=1)
+def get_dummy_password_hash():
+    """Hash at the configured cost, verified against for unknown users to equalize timing."""
+    return get_password_hash(secrets.token_urlsafe(16))
 
 async def get_current_admin(token: str = Depends(oauth2_scheme), session: Session = Depends(get_session)):
     credentials_exception = HTTPException(
@@ -40,28 +132,55 @@ async def get_current_admin(token: str = Depends(oauth2_scheme), session: Sessio
         detail="Could not validate credentials",
         headers={"WWW-Authenticate": "Bearer"},
     )
+
+    # Raw 16-byte digest as the key: cheaper than sha256 + hex on short tokens, collisions are not a concern at 128 bits
+    cache_key = hashlib.blake2b(token.encode(), digest_size=16).digest()
+    with _auth_cache_lock:
+        cached = _token_cache.get(cache_key)
+    if cached is not None:
+        exp, cached_admin = cached
+        if exp > time.time():
+            return cached_admin
+
     try:
-        payload = jwt.decode(token, settings.SECRET_KEY, algorithms=[ALGORITHM])
+        payload = _jwt.decode(token, **_JWT_DECODE_KWARGS)
         username: str = payload.get("sub")
         if username is None:
             raise credentials_exception
     except jwt.PyJWTError:
         raise credentials_exception
         
-    statement = select(Admin).where(Admin.username == username)
-    admin = session.exec(statement).first()
+    with _auth_cache_lock:
+        admin = _admin_cache.get(username)
+
     if admin is None:
-        raise credentials_exception
+        db_admin = session.exec(ADMIN_BY_USERNAME, params={"username": username}).first()
+        if db_admin is None:
+            raise credentials_exception
+
+        # Cache a detached copy: the session-bound row is expired on commit and unusable in later requests
+        admin = Admin.model_validate(db_admin.model_dump())
+        with _auth_cache_lock:
+            _admin_cache[username] = admin
+
+    with _auth_cache_lock:
+        _token_cache[cache_key] = (payload["exp"], admin)
     return admin
 
-async def verify_agent_token(token: str = Depends(api_key_header)):
-    # Use the configured AGENT_TOKEN
+def invalidate_admin_cache(username: str):
+    """Drop the cached snapshot of an admin whose row was created or changed."""
+    with _auth_cache_lock:
+        _admin_cache.pop(username, None)
 
-    if not settings.AGENT_TOKEN:
-         print("CRITICAL: AGENT_TOKEN not configured on server.")
+async def verify_agent_token(token: str = Depends(api_key_header)):
+    # Use the configured AGENT_TOKEN, encoded once in Settings.__init__
+    expected = settings.AGENT_TOKEN_BYTES
+    if not expected:
+         logger.critical("AGENT_TOKEN not configured on server.")
          raise HTTPException(status_code=500, detail="Server Configuration Error")
 
-    if not token or not secrets.compare_digest(token, settings.AGENT_TOKEN):
+    # Constant-time compare on bytes (str compare_digest rejects non-ASCII input)
+    if not token or not secrets.compare_digest(token.encode("utf-8"), expected):
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Invalid Agent Token",
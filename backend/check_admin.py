@@ -1,25 +1,26 @@
-from sqlmodel import Session, select, create_engine
+from sqlmodel import select, func
+from database import session_scope
 from models import Admin
-from passlib.context import CryptContext
 
-# Connect to the database
-engine = create_engine("sqlite:///database.db")
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+def main():
+    with session_scope() as session:
+        count = session.exec(select(func.count()).select_from(Admin)).one()
+        print(f"Found {count} admins.")
 
-def get_password_hash(password):
-    return pwd_context.hash(password)
+        if not count:
+            # Imported lazily: auth pulls in settings and the bcrypt cost, only needed when seeding
+            from auth import get_password_hash
 
-with Session(engine) as session:
-    admins = session.exec(select(Admin)).all()
-    print(f"Found {len(admins)} admins.")
-    
-    if not admins:
-        print("Creating default admin user...")
-        hashed_pwd = get_password_hash("unsafe-secret-key-change-me")
-        admin = Admin(username="admin", role="superadmin", hashed_password=hashed_pwd)
-        session.add(admin)
-        session.commit()
-        print("Admin user created.")
-    else:
-        for admin in admins:
-            print(f"Username: {admin.username}, Role: {admin.role}, Hash: {admin.hashed_password[:10]}...")
+            print("Creating default admin user...")
+            hashed_pwd = get_password_hash("unsafe-secret-key-change-me")
+            admin = Admin(username="admin", role="superadmin", hashed_password=hashed_pwd)
+            session.add(admin)
+            session.commit()
+            print("Admin user created.")
+        else:
+            # Only the printed columns
+            for username, role in session.exec(select(Admin.username, Admin.role)):
+                print(f"Username: {username}, Role: {role}")
+
+if __name__ == "__main__":
+    main()
@@ -1,155 +1,233 @@
 import os
 import sys
+import logging
 import secrets
-from dotenv import load_dotenv
+from contextlib import suppress
+from functools import cached_property, lru_cache
+from dotenv import dotenv_values, load_dotenv
 
-load_dotenv()
+# Deployments that inject the environment directly can skip reading .env altogether
+if os.getenv("SKIP_DOTENV") != "1":
+    load_dotenv(override=False)
 
-# Cross-platform file locking helper
-def _lock_file(f, exclusive=True):
-    """Lock a file in a cross-platform way."""
-    if sys.platform == 'win32':
-        import msvcrt
+logger = logging.getLogger(__name__)
+
+# Cross-platform file locking helpers, bound once for this platform at import
+if sys.platform == 'win32':
+    import msvcrt
+
+    def _lock_file(f, exclusive=True):
+        """Lock a file (Windows)."""
         msvcrt.locking(f.fileno(), msvcrt.LK_LOCK if exclusive else msvcrt.LK_NBLCK, 1)
-    else:
-        import fcntl
-        fcntl.flock(f, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
 
-def _unlock_file(f):
-    """Unlock a file in a cross-platform way."""
-    if sys.platform == 'win32':
-        import msvcrt
-        try:
+    def _unlock_file(f):
+        """Unlock a file (Windows)."""
+        with suppress(Exception):  # Ignore unlock errors on Windows
             msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
-        except Exception:
-            pass  # Ignore unlock errors on Windows
-    else:
-        import fcntl
+else:
+    import fcntl
+
+    def _lock_file(f, exclusive=True):
+        """Lock a file (POSIX)."""
+        fcntl.flock(f, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+
+    def _unlock_file(f):
+        """Unlock a file (POSIX)."""
         fcntl.flock(f, fcntl.LOCK_UN)
 
-class Settings:
-    AD_SERVER = os.getenv("AD_SERVER", "localhost")
-    AD_USER = os.getenv("AD_USER", "admin@example.com")
-    AD_PASSWORD = os.getenv("AD_PASSWORD")
-    AD_BASE_DN = os.getenv("AD_BASE_DN", "DC=example,DC=com")
-    USE_MOCK_LDAP = os.getenv("USE_MOCK_LDAP", "True").lower() == "true"
-    SECRET_KEY = os.getenv("SECRET_KEY")
-    AGENT_TOKEN = os.getenv("AGENT_TOKEN")
-    AGENT_ONLY = os.getenv("AGENT_ONLY", "False").lower() == "true"
-    ALLOWED_ORIGINS = [origin.strip() for origin in os.getenv("ALLOWED_ORIGINS", "http://localhost:5173,http://localhost:3000").split(",")]
-    BASE_URL = os.getenv("BASE_URL", "http://localhost:8000")
-    ADMIN_PASSWORD = os.getenv("ADMIN_PASSWORD")
-    TRUST_PROXY_HEADERS = os.getenv("TRUST_PROXY_HEADERS", "False").lower() == "true"
-    MAX_UPLOAD_SIZE = int(os.getenv("MAX_UPLOAD_SIZE", 10 * 1024 * 1024 * 1024)) # 10 GB Default
+SECRETS_FILE = "secrets.env"
+
+# Parsed secrets files keyed by (path, mtime_ns, size), so an unchanged file is never re-read
+_secrets_file_cache = {}
+
+def _read_secrets_file(path=SECRETS_FILE):
+    """Return the key/value pairs of a secrets file, parsing it only when it changed."""
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return {}
+
+    cache_key = (path, st.st_mtime_ns, st.st_size)
+    entries = _secrets_file_cache.get(cache_key)
+    if entries is None:
+        # python-dotenv handles quoting, export prefixes and comments. No interpolation: secrets are literal.
+        entries = {k: v for k, v in dotenv_values(path, interpolate=False).items() if v is not None}
+        _secrets_file_cache[cache_key] = entries
+    return entries
+
+def _atomic_upsert(path, values):
+    """Set keys in a dotenv file, replacing existing lines and dropping duplicates.
+
+    Comments and unrelated lines are kept. The result is written to a temp file and
+    swapped in with os.replace, so readers never see a partial file. Writers are
+    serialized through a sidecar lock file so concurrent workers cannot lose updates.
+    Returns False without writing when the file already has these exact values.
+    """
+    with open(f"{path}.lock", "a") as lock:
+        _lock_file(lock, exclusive=True)
+        try:
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    lines = f.read().splitlines()
+            except FileNotFoundError:
+                lines = []
+
+            pending = dict(values)
+            output = []
+            for line in lines:
+                stripped = line.strip()
+                if "=" in stripped and not stripped.startswith("#"):
+                    key = stripped.split("=", 1)[0].strip()
+                    if key.startswith("export "):
+                        key = key[len("export "):].strip()
+                    if key in values:
+                        if key in pending:
+                            output.append(f"{key}={pending.pop(key)}")
+                        continue  # Older duplicate of a key we just set
+                output.append(line)
+            output.extend(f"{key}={value}" for key, value in pending.items())
+            if output == lines:
+                return False  # Every key already holds this value; leave the file untouched
+
+            # Created owner-only (0600) with one raw write: the file holds secrets
+            tmp_path = f"{path}.tmp"
+            with suppress(FileNotFoundError):
+                os.unlink(tmp_path)  # Leftover from a crashed writer; O_EXCL needs it gone
+            fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, "O_BINARY", 0), 0o600)
+            try:
+                os.write(fd, ("\n".join(output) + "\n").encode("utf-8"))
+            finally:
+                os.close(fd)
+            os.replace(tmp_path, path)
+            return True
+        finally:
+            _unlock_file(lock)
 
-    def __init__(self):
+def _to_bool(raw):
+    return raw.lower() in ("true", "1", "yes", "on")
 
-        self._load_from_secrets_file()
-        
-        # Load again from env to ensure priority
-        self.AD_PASSWORD = os.getenv("AD_PASSWORD", self.AD_PASSWORD)
-        self.SECRET_KEY = os.getenv("SECRET_KEY", self.SECRET_KEY)
+# Field type -> converter for raw environment/secrets.env strings
+_COERCERS = {bool: _to_bool, int: int, str: str}
 
-        self.AGENT_TOKEN = os.getenv("AGENT_TOKEN", self.AGENT_TOKEN)
+class Settings:
+    # name -> (type, default). Each value is read from the environment (then secrets.env) on first access.
+    _FIELDS = {
+        "AD_SERVER": (str, "localhost"),
+        "AD_USER": (str, "admin@example.com"),
+        "AD_PASSWORD": (str, None),
+        "AD_BASE_DN": (str, "DC=example,DC=com"),
+        "USE_MOCK_LDAP": (bool, True),
+        "SECRET_KEY": (str, None),
+        "AGENT_TOKEN": (str, None),
+        "AGENT_ONLY": (bool, False),
+        "ALLOWED_ORIGINS": (str, "http://localhost:5173,http://localhost:3000"),
+        "BASE_URL": (str, "http://localhost:8000"),
+        "ADMIN_PASSWORD": (str, None),
+        "TRUST_PROXY_HEADERS": (bool, False),
+        "MAX_UPLOAD_SIZE": (int, 10 * 1024 * 1024 * 1024), # 10 GB Default
+        "BCRYPT_COST": (int, 0), # 0 = calibrate to this host on first start
+        "JWT_CACHE_TTL_SECONDS": (int, 10),
+        "JWT_CACHE_MAX": (int, 10000),
+        "LOG_LEVEL": (str, "INFO"),
+    }
 
+    def __init__(self):
+        self._file_values = self._load_from_secrets_file()
+
+        # Startup validation stays eager: production must fail fast, not on first use
         if not self.USE_MOCK_LDAP:
             if not self.AD_PASSWORD:
                  raise ValueError("CRITICAL ERROR: AD_PASSWORD is missing in production mode!")
         
         # Secrets Management
+        # Generated secrets are collected and persisted in one pass per file
+        generated = {}
         if not self.SECRET_KEY:
             if not self.USE_MOCK_LDAP:
-                 print("CRITICAL WARNING: SECRET_KEY is missing in production. Sessions will be insecure.")
+                 logger.critical("SECRET_KEY is missing in production. Sessions will be insecure.")
                  # Ideally we should raise here too, but for now we warn loudly.
             else:
                 self.SECRET_KEY = secrets.token_urlsafe(32)
-                self._save_secret("SECRET_KEY", self.SECRET_KEY)
-                print("WARNING: SECRET_KEY was missing. Generated and saved (Dev/Mock Mode).")
+                generated["SECRET_KEY"] = self.SECRET_KEY
+                logger.warning("SECRET_KEY was missing. Generated and saved (Dev/Mock Mode).")
 
         # Default token logic: "agent-" + first 8 chars of SECRET_KEY (see SETUP.md)
         if not self.AGENT_TOKEN:
             if not self.USE_MOCK_LDAP:
 
-                print("CRITICAL WARNING: AGENT_TOKEN is missing in production! Generating and SAVING a random token.")
+                logger.critical("AGENT_TOKEN is missing in production! Generating and SAVING a random token.")
                 self.AGENT_TOKEN = f"agent-PROD-{secrets.token_urlsafe(24)}"
-                self._save_secret("AGENT_TOKEN", self.AGENT_TOKEN)
+                generated["AGENT_TOKEN"] = self.AGENT_TOKEN
             else:
                 # In Mock/Dev, we can auto-generate
-                prefix = self.SECRET_KEY[:8] if self.SECRET_KEY else "unknown"
-                self.AGENT_TOKEN = f"agent-{prefix}-{secrets.token_urlsafe(24)}"
-                self._save_secret("AGENT_TOKEN", self.AGENT_TOKEN)
-                print(f"WARNING: AGENT_TOKEN was missing. Generated and saved (Dev/Mock Mode).")
-
+                self.AGENT_TOKEN = self._default_agent_token(self.SECRET_KEY)
+                generated["AGENT_TOKEN"] = self.AGENT_TOKEN
+                logger.warning("AGENT_TOKEN was missing. Generated and saved (Dev/Mock Mode).")
+
+        if generated:
+            self._save_secrets(generated)
+
+        # Derived values, computed once so request paths never re-encode them
+        self.SECRET_KEY_BYTES = self.SECRET_KEY.encode("utf-8") if self.SECRET_KEY else None
+        self.AGENT_TOKEN_BYTES = self.AGENT_TOKEN.encode("utf-8") if self.AGENT_TOKEN else b""
+
+    @staticmethod
+    def _default_agent_token(secret_key):
+        """Dev/Mock agent token: "agent-" + first 8 chars of SECRET_KEY + a random suffix."""
+        prefix = secret_key[:8] if secret_key else "unknown"
+        return f"agent-{prefix}-{secrets.token_urlsafe(24)}"
+
+    def __getattr__(self, name):
+        # Only reached for fields not resolved yet; the result is cached on the instance
+        field = self._FIELDS.get(name)
+        if field is None:
+            raise AttributeError(f"{type(self).__name__!r} object has no attribute {name!r}")
+        value = self._resolve(name, *field)
+        self.__dict__[name] = value
+        return value
+
+    def _resolve(self, name, field_type, default):
+        raw = os.getenv(name)
+        if raw is None:
+            raw = self._file_values.get(name)
+        if raw is None:
+            return default
+        return _COERCERS[field_type](raw)
+
+    @cached_property
+    def ALLOWED_ORIGINS(self):
+        raw = self._resolve("ALLOWED_ORIGINS", *self._FIELDS["ALLOWED_ORIGINS"])
+        # frozenset: the CORS middleware does an `origin in allow_origins` check per request
+        return frozenset(sys.intern(o.strip()) for o in raw.split(",") if o.strip())
 
     def _load_from_secrets_file(self):
         """Load secrets from a dedicated persistence file."""
         try:
-            if os.path.exists("secrets.env"):
-                with open("secrets.env", "r") as f:
-                    _lock_file(f, exclusive=False)
-                    try:
-                        # Loop over lines
-                        for line in f:
-                            if "=" in line:
-                                k, v = line.strip().split("=", 1)
-
-                                # if k not in os.environ:
-                                #    os.environ[k] = v
-                                
-                                # Also update self if it maps to a property, respecting type
-                                if hasattr(self, k):
-                                    current_val = getattr(self, k)
-
-                                    if current_val is None:
-                                        v_typed = v
-                                    else:
-                                        target_type = type(current_val)
-                                        
-                                        if target_type == bool:
-                                            v_typed = v.lower() in ("true", "1", "yes", "on")
-                                        elif target_type == int:
-                                            try:
-                                                v_typed = int(v)
-                                            except ValueError:
-                                                v_typed = v
-                                        else:
-                                            v_typed = v
-                                        
-                                    setattr(self, k, v_typed)
-                    finally:
-                        _unlock_file(f)
+            return _read_secrets_file()
         except Exception as e:
-            print(f"Failed to load secrets.env: {e}")
+            logger.error("Failed to load secrets.env: %s", e)
+            return {}
 
     def _save_secret(self, key, value):
-        """Persist secret to both .env and secrets.env for redundancy"""
-        for filepath in [".env", "secrets.env"]:
+        """Persist a single secret (see _save_secrets)."""
+        self._save_secrets({key: value})
+
+    def _save_secrets(self, values):
+        """Persist secrets to both .env and secrets.env for redundancy."""
+        changed = False
+        for filepath in [".env", SECRETS_FILE]:
             try:
-                # Open in append mode, but we need a lock. 
-                # We open with 'a+' to read/write/append
-                with open(filepath, "a+") as f:
-                    _lock_file(f, exclusive=True)
-                    try:
-                        # Check if key exists already to avoid duplicates?
-                        # It's expensive to read all. We just append. 
-                        # Last value usually wins in doten.
-                        
-                        ensure_newline = False
-                        f.seek(0, 2)  # Seek to end
-                        file_size = f.tell()
-                        if file_size > 0:
-                            f.seek(file_size - 1)
-                            if f.read(1) != "\n":
-                                ensure_newline = True
-                        
-                        if ensure_newline:
-                            f.write("\n")
-                        f.write(f"{key}={value}\n")
-                    finally:
-                        _unlock_file(f)
+                changed |= _atomic_upsert(filepath, values)
             except Exception as e:
-                print(f"Failed to save {key} to {filepath}: {e}")
+                logger.error("Failed to save %s to %s: %s", ", ".join(values), filepath, e)
+
+        if changed:
+            # The files changed on disk; drop every parsed copy
+            _secrets_file_cache.clear()
 
-    # _append_to_file removed as it is now integrated with locking above
+@lru_cache(maxsize=1)
+def get_settings():
+    """Process-wide Settings singleton."""
+    return Settings()
 
-settings = Settings()
+settings = get_settings()
@@ -1,22 +1,99 @@
+import os
+from contextlib import contextmanager
 from sqlmodel import SQLModel, create_engine, Session
+from sqlmodel.ext.asyncio.session import AsyncSession
 
 sqlite_file_name = "database.db"
 sqlite_url = f"sqlite:///{sqlite_file_name}"
 
 from sqlalchemy import event
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlalchemy.schema import CreateIndex
 
-connect_args = {"check_same_thread": False}
-engine = create_engine(sqlite_url, echo=True, connect_args=connect_args)
+# cached_statements: sqlite3's per-connection cache of prepared statements (default 128). The app's
+# statements are all parameterized, so each distinct SQL string is parsed once per pooled connection.
+SQLITE_CACHED_STATEMENTS = 256
+connect_args = {"check_same_thread": False, "cached_statements": SQLITE_CACHED_STATEMENTS}
+SQL_ECHO = os.getenv("SQL_ECHO", "").lower() in ("1", "true")
+# Sized for heartbeat bursts: WAL lets readers proceed alongside the single writer, so a checkout
+# shouldn't have to wait on the pool. Connections are reused, not pinged (a local file doesn't go stale).
+# Each engine (sync and async) has its own pool, and every connection its own page cache (below), so
+# the pools are also the memory budget: with the defaults at most 2 x (10 + 20) = 60 connections.
+POOL_OPTIONS = {
+    "pool_size": int(os.getenv("DB_POOL_SIZE", "10")),
+    "max_overflow": int(os.getenv("DB_MAX_OVERFLOW", "20")),
+    "pool_pre_ping": False,
+}
+# SQLAlchemy's compiled-statement cache, per engine (default 500 entries). Every expanding IN size and
+# every distinct ORM load is its own entry, so the default can churn under varied management queries.
+QUERY_CACHE_SIZE = int(os.getenv("DB_QUERY_CACHE_SIZE", "1200"))
+# SQL logging is opt-in (SQL_ECHO=1): echoing every statement dominates the cost of small queries.
+# QueuePool (the file-backed SQLite default) with explicit sizing.
+engine = create_engine(
+    sqlite_url,
+    echo=SQL_ECHO,
+    connect_args=connect_args,
+    query_cache_size=QUERY_CACHE_SIZE,
+    **POOL_OPTIONS,
+)
+
+# Per-connection tuning, sent to SQLite in one call.
+# WAL + synchronous=NORMAL: readers don't block the writer and commits don't fsync (only checkpoints do).
+# Under constant heartbeat/ack writes the WAL is truncated back to 64 MB after each checkpoint instead
+# of keeping its high-water size, and a writer waits up to 5s for the lock instead of failing.
+# cache_size is per connection: 8 MB each, so at most 60 x 8 MB = 480 MB with the default pools (a
+# connection's cache only fills as it reads). The 256 MB mmap is the OS page cache, shared by all of them.
+SQLITE_PRAGMAS = """
+PRAGMA journal_mode=WAL;
+PRAGMA synchronous=NORMAL;
+PRAGMA journal_size_limit=67108864;
+PRAGMA busy_timeout=5000;
+PRAGMA temp_store=MEMORY;
+PRAGMA mmap_size=268435456;
+PRAGMA cache_size=-8192;
+"""
 
 @event.listens_for(engine, "connect")
 def set_sqlite_pragma(dbapi_connection, connection_record):
+    dbapi_connection.executescript(SQLITE_PRAGMAS)
+
+# Same file for the agent endpoints, which run on the event loop instead of the threadpool
+async_engine = create_async_engine(
+    f"sqlite+aiosqlite:///{sqlite_file_name}",
+    echo=SQL_ECHO,
+    connect_args={"cached_statements": SQLITE_CACHED_STATEMENTS},
+    query_cache_size=QUERY_CACHE_SIZE,
+    **POOL_OPTIONS,
+)
+
+@event.listens_for(async_engine.sync_engine, "connect")
+def set_async_sqlite_pragma(dbapi_connection, connection_record):
+    # The aiosqlite adapter has no executescript
     cursor = dbapi_connection.cursor()
-    cursor.execute("PRAGMA journal_mode=WAL")
+    for pragma in filter(None, (line.strip().rstrip(";") for line in SQLITE_PRAGMAS.splitlines())):
+        cursor.execute(pragma)
     cursor.close()
 
 def create_db_and_tables():
     SQLModel.metadata.create_all(engine)
+    # create_all skips tables that already exist, so indexes added to the models later are created here.
+    # IF NOT EXISTS rather than checkfirst: SQLite's index reflection doesn't report expression indexes.
+    with engine.begin() as conn:
+        for table in SQLModel.metadata.sorted_tables:
+            for index in table.indexes:
+                conn.execute(CreateIndex(index, if_not_exists=True))
 
 def get_session():
     with Session(engine) as session:
         yield session
+
+async def get_async_session():
+    # Nothing is reloaded after commit: lazy loads aren't possible on an async session
+    async with AsyncSession(async_engine, expire_on_commit=False) as session:
+        yield session
+
+@contextmanager
+def session_scope():
+    """Session for scripts and one-off jobs; the connection goes back to the pool on exit."""
+    with Session(engine) as session:
+        yield session
@@ -1,3 +1,4 @@
+import sys
 import httpx
 import asyncio
 from config import settings
@@ -5,7 +6,9 @@ from config import settings
 BASE_URL = "http://localhost:8000/api/v1"
 
 async def main():
-    async with httpx.AsyncClient() as client:
+    # One pooled client; keep-alive connections are reused for every request below
+    limits = httpx.Limits(max_keepalive_connections=10, keepalive_expiry=30)
+    async with httpx.AsyncClient(limits=limits) as client:
         # 1. Login
         print(f"Logging in with admin / {settings.SECRET_KEY[:5]}...")
         try:
@@ -28,15 +31,20 @@ async def main():
             print("Login Success!")
             headers = {"Authorization": f"Bearer {token}"}
             
-            # 2. Get AD Tree
-            print("\n--- AD TREE ---")
-            resp = await client.get(f"{BASE_URL}/management/ad/tree", headers=headers)
-            print(resp.json())
+            # 2. + 3. AD Tree and Software are independent, fetch them concurrently
+            tree_resp, software_resp = await asyncio.gather(
+                client.get(f"{BASE_URL}/management/ad/tree", headers=headers),
+                client.get(f"{BASE_URL}/management/software", headers=headers),
+            )
+
+            # Raw bodies go straight to stdout; no JSON decode just to print it
+            print("\n--- AD TREE ---", flush=True)
+            sys.stdout.buffer.write(tree_resp.content + b"\n")
+            sys.stdout.buffer.flush()
             
-            # 3. Get Software
-            print("\n--- SOFTWARE ---")
-            resp = await client.get(f"{BASE_URL}/management/software", headers=headers)
-            print(resp.json())
+            print("\n--- SOFTWARE ---", flush=True)
+            sys.stdout.buffer.write(software_resp.content + b"\n")
+            sys.stdout.buffer.flush()
             
         except Exception as e:
             print(f"Error: {e}")
@@ -1,20 +1,31 @@
-from database import get_session
+from database import session_scope
 from models import MachineSoftwareLink, Deployment, Machine
 from sqlmodel import select
 
-session = next(get_session())
+with session_scope() as session:
+    print("--- DEPLOYMENTS ---")
+    # Rows are streamed in batches of 500 instead of materialized with .all()
+    deps = session.exec(select(
+        Deployment.id, Deployment.target_value, Deployment.target_type, Deployment.action, Deployment.software_id
+    ).execution_options(yield_per=500))
+    for dep_id, target_value, target_type, action, software_id in deps:
+        print(f"Dep ID: {dep_id}, Target: {target_value} ({target_type}), Action: {action}, SoftwareID: {software_id}")
 
-print("--- DEPLOYMENTS ---")
-deps = session.exec(select(Deployment)).all()
-for d in deps:
-    print(f"Dep ID: {d.id}, Target: {d.target_value} ({d.target_type}), Action: {d.action}, SoftwareID: {d.software_id}")
-
-print("\n--- MACHINES ---")
-machines = session.exec(select(Machine)).all()
-for m in machines:
-    print(f"Machine ID: {m.id}, Hostname: {m.hostname}")
-
-print("\n--- LINKS ---")
-links = session.exec(select(MachineSoftwareLink)).all()
-for l in links:
-    print(f"Machine: {l.machine_id}, Software: {l.software_id}, Status: {l.status}, Version: {l.installed_version}")
+    # Machines and their links in one query: one row per link, or one row for a machine without links
+    print("\n--- MACHINES / LINKS ---")
+    rows = session.exec(
+        select(
+            Machine.id, Machine.hostname,
+            MachineSoftwareLink.software_id, MachineSoftwareLink.status, MachineSoftwareLink.installed_version,
+        )
+        .join(MachineSoftwareLink, MachineSoftwareLink.machine_id == Machine.id, isouter=True)
+        .order_by(Machine.id)
+        .execution_options(yield_per=500)
+    )
+    current_machine = None
+    for machine_id, hostname, software_id, status, version in rows:
+        if machine_id != current_machine:
+            current_machine = machine_id
+            print(f"Machine ID: {machine_id}, Hostname: {hostname}")
+        if software_id is not None:
+            print(f"  Software: {software_id}, Status: {status}, Version: {version}")
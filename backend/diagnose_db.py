@@ -1,23 +1,24 @@
-from sqlmodel import Session, select, create_engine
+from sqlmodel import select
 from models import Software, Machine
-from database import sqlite_url
-
-# Force absolute path if needed, but relative should work in container
-engine = create_engine(sqlite_url)
+from database import session_scope
 
 try:
-    with Session(engine) as session:
+    with session_scope() as session:
         print("--- DIAGNOSTIC START ---")
-        softwares = session.exec(select(Software)).all()
-        machines = session.exec(select(Machine)).all()
-        
-        print(f"Softwares found: {len(softwares)}")
-        for s in softwares:
-            print(f" - {s.name} ({s.version})")
+        # Only the printed columns, streamed in batches instead of loaded up front
+        print("Softwares:")
+        software_count = 0
+        for name, version in session.exec(select(Software.name, Software.version).execution_options(yield_per=500)):
+            print(f" - {name} ({version})")
+            software_count += 1
+        print(f"Softwares found: {software_count}")
             
-        print(f"Machines found: {len(machines)}")
-        for m in machines:
-            print(f" - {m.hostname} ({m.mac_address})")
+        print("Machines:")
+        machine_count = 0
+        for hostname, mac_address in session.exec(select(Machine.hostname, Machine.mac_address).execution_options(yield_per=500)):
+            print(f" - {hostname} ({mac_address})")
+            machine_count += 1
+        print(f"Machines found: {machine_count}")
         print("--- DIAGNOSTIC END ---")
 except Exception as e:
     print(f"Error: {e}")
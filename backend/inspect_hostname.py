@@ -1,9 +1,9 @@
-from sqlmodel import Session, select
-from database import engine
+from sqlmodel import select
+from database import session_scope
 from models import Machine
 
 def inspect():
-    with Session(engine) as session:
+    with session_scope() as session:
         machines = session.exec(select(Machine)).all()
         for m in machines:
             print(f"ID: {m.id} | Hostname repr: {repr(m.hostname)}")
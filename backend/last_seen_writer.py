@@ -0,0 +1,76 @@
+import asyncio
+import logging
+from datetime import datetime
+from typing import Dict, Optional
+
+from sqlalchemy import bindparam, update
+from database import async_engine
+from models import Machine
+
+logger = logging.getLogger(__name__)
+
+# Heartbeat last_seen stamps are collected here and written every few seconds as one
+# executemany UPDATE, instead of each heartbeat dirtying and committing its machine row.
+# Last writer wins: only the newest stamp per machine matters.
+LAST_SEEN_FLUSH_INTERVAL_SECONDS = 5.0
+
+LAST_SEEN_UPDATE = (
+    update(Machine)
+    .where(Machine.id == bindparam("machine_id"))
+    .values(last_seen=bindparam("last_seen"))
+)
+
+_pending: Dict[int, datetime] = {}
+_writer: Optional[asyncio.Task] = None
+_stopping: Optional[asyncio.Event] = None
+
+def record(machine_id: int, last_seen: datetime) -> bool:
+    """Schedule a last_seen write. False if the writer isn't running and the caller should write it itself."""
+    if _writer is None:
+        return False
+    _pending[machine_id] = last_seen
+    return True
+
+async def flush():
+    if not _pending:
+        return
+
+    rows = [{"machine_id": mid, "last_seen": ts} for mid, ts in _pending.items()]
+    _pending.clear()
+    try:
+        # Core executemany: no ORM state involved, and a machine deleted meanwhile just matches no row
+        async with async_engine.begin() as conn:
+            await conn.execute(LAST_SEEN_UPDATE, rows)
+    except Exception as e:
+        logger.error("Failed to write last_seen for %d machines, retrying with the next flush: %s", len(rows), e)
+        # Stamps recorded since are newer and win
+        for row in rows:
+            _pending.setdefault(row["machine_id"], row["last_seen"])
+
+async def _run(stopping: asyncio.Event):
+    while not stopping.is_set():
+        try:
+            await asyncio.wait_for(stopping.wait(), LAST_SEEN_FLUSH_INTERVAL_SECONDS)
+        except asyncio.TimeoutError:
+            pass
+        await flush()
+
+def start():
+    global _writer, _stopping
+    if _writer is not None:
+        return
+    _stopping = asyncio.Event()
+    _writer = asyncio.create_task(_run(_stopping))
+
+async def stop():
+    """Stop the writer after a final flush of the pending stamps."""
+    global _writer, _stopping
+    if _writer is None:
+        return
+    _stopping.set()
+    await _writer
+    _writer = _stopping = None
+    # Stamps recorded while the last flush was running
+    await flush()
+    if _pending:
+        logger.error("Shutting down with last_seen unwritten for %d machines", len(_pending))
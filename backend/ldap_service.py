@@ -1,13 +1,24 @@
-from typing import List, Dict, Any, Optional
+from typing import List, Dict, Any, Optional, Tuple
+from functools import lru_cache
+from collections import defaultdict
+from types import SimpleNamespace
 import re
-from ldap3 import Server, Connection, ALL, SUBTREE
-from ldap3.utils.conv import escape_filter_chars
-from ldap3.utils.dn import parse_dn
+import logging
+import queue
+import threading
+import time
+from contextlib import contextmanager
+import anyio
+from cachetools import TTLCache
 from sqlmodel import Session, select
 from config import settings
 from models import Machine
 
+logger = logging.getLogger(__name__)
+
 # Fallback: escape_dn_chars may not exist in all ldap3 versions
+# Memoized: the same hostnames are escaped on every check-in and tree build
+@lru_cache(maxsize=4096)
 def escape_dn_chars(s: str) -> str:
     """Escape special characters in DN component values."""
     # Characters that need escaping in DN values: , + " \ < > ;
@@ -16,8 +27,186 @@ def escape_dn_chars(s: str) -> str:
         s = s.replace(char, escaped)
     return s
 
+# The first RDN up to its terminating comma: plain characters, backslash escapes (including
+# an escaped backslash before a real separator) and quoted values, so a DN is split in C
+_FIRST_RDN = re.compile(r'(?:[^\\",]|\\.|"(?:[^"\\]|\\.)*")*,', re.DOTALL)
+
+@lru_cache(maxsize=65536)
+def _parent_of(dn: str) -> Optional[str]:
+    """DN with its first RDN stripped, or None for a single-RDN DN.
+
+    The parent keeps the original escaping, so it matches the parent's own DN as AD
+    returns it. Memoized: siblings share parents and the tree is rebuilt from mostly
+    the same DNs on every refresh.
+    """
+    match = _FIRST_RDN.match(dn)
+    if match is None:
+        return None
+    return dn[match.end():].lstrip() or None
+
+@lru_cache(maxsize=4096)
+def ou_suffixes(ou_path: str) -> Tuple[str, ...]:
+    """Containers a machine DN falls under, most specific first.
+
+    A leading CN= RDN (the computer itself) is dropped:
+    CN=PC1,OU=Sales,DC=example,DC=com -> (OU=Sales,DC=example,DC=com, DC=example,DC=com, DC=com)
+    Values keep the DN's own escaping, so they compare equal to stored target DNs.
+    Memoized per DN; machines in the same OU share it.
+    """
+    if "\\" not in ou_path and '"' not in ou_path:
+        # Nothing escaped or quoted: every comma separates RDNs, so a plain split does the regex's job.
+        # Same results as the loop below: parents are left-stripped, and the walk ends at the first empty one.
+        parts = ou_path.split(",")
+        suffixes = []
+        for i in range(1 if parts[0][:3].upper() == "CN=" else 0, len(parts)):
+            dn = ",".join(parts[i:])
+            if i:
+                dn = dn.lstrip()
+            if not dn:
+                break
+            suffixes.append(dn)
+        return tuple(suffixes)
+
+    dn = ou_path
+    if dn[:3].upper() == "CN=":
+        dn = _parent_of(dn)
+    suffixes = []
+    while dn:
+        suffixes.append(dn)
+        dn = _parent_of(dn)
+    return tuple(suffixes)
+
+# Agent-Only trees are served from memory for this long and also dropped on machine changes
+TREE_CACHE_TTL_SECONDS = 30
+# Age after which the real AD tree snapshot is rebuilt in the background
+AD_TREE_REFRESH_SECONDS = 60
+# resolve_machine_ou results: found DNs are kept longer than misses, so a typo doesn't pin "Unknown"
+OU_CACHE_TTL_SECONDS = 300
+OU_NEGATIVE_CACHE_TTL_SECONDS = 30
+
+@lru_cache(maxsize=1)
+def _load_ldap3():
+    """Import ldap3 on first real AD use; Mock and Agent-Only deployments never load it."""
+    from ldap3 import Server, Connection, NONE, SIMPLE
+    from ldap3.core.exceptions import LDAPBindError
+    from ldap3.utils.conv import escape_filter_chars
+    return SimpleNamespace(
+        Server=Server,
+        Connection=Connection,
+        NONE=NONE,
+        SIMPLE=SIMPLE,
+        LDAPBindError=LDAPBindError,
+        escape_filter_chars=escape_filter_chars,
+    )
+
+@lru_cache(maxsize=4096)
+def _escape_filter(value: str) -> str:
+    """ldap3's escape_filter_chars, memoized for repeated usernames and hostnames."""
+    return _load_ldap3().escape_filter_chars(value)
+
+# Service-account connections kept bound between requests
+LDAP_POOL_SIZE = 4
+LDAP_POOL_LIFETIME_SECONDS = 600 # Below AD's default 15 min idle disconnect
+LDAP_POOL_TIMEOUT_SECONDS = 10
+# AD's default MaxPageSize; larger requests are capped by the server anyway
+AD_PAGE_SIZE = 1000
+
+def _first_value(value) -> str:
+    """Attribute value from a raw search response.
+
+    Without the schema (get_info=NONE) ldap3 can't tell single-valued attributes
+    apart, so they may arrive as one-element lists.
+    """
+    if isinstance(value, (list, tuple)):
+        return str(value[0]) if value else ""
+    return "" if value is None else str(value)
+
+class _ServiceConnectionPool:
+    """Bound service-account connections, reused instead of connecting and binding per call.
+
+    A connection is used by one thread at a time (ldap3's default strategy is not
+    thread-safe). Connections past their lifetime, closed, or that raised are replaced.
+    """
+
+    def __init__(self, size: int, lifetime: float):
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(size)
+        self._lifetime = lifetime
+        self._server = None
+
+    @property
+    def server(self):
+        if self._server is None:
+            ldap3 = _load_ldap3()
+            # No RootDSE/schema download on connect: only plain attribute searches are issued
+            self._server = ldap3.Server(settings.AD_SERVER, get_info=ldap3.NONE, connect_timeout=2)
+        return self._server
+
+    def _open(self):
+        ldap3 = _load_ldap3()
+        conn = ldap3.Connection(
+            self.server,
+            user=settings.AD_USER,
+            password=settings.AD_PASSWORD,
+            auto_bind=True,
+            raise_exceptions=True,
+            fast_decoder=True, # ldap3's streaming BER decoder, spelled out since large searches depend on it
+        )
+        return conn, time.monotonic()
+
+    @staticmethod
+    def _close(conn):
+        try:
+            conn.unbind()
+        except Exception:
+            pass
+
+    @contextmanager
+    def connection(self):
+        if not self._slots.acquire(timeout=LDAP_POOL_TIMEOUT_SECONDS):
+            raise TimeoutError("No LDAP connection available")
+        try:
+            try:
+                conn, opened_at = self._idle.get_nowait()
+                if conn.closed or time.monotonic() - opened_at > self._lifetime:
+                    self._close(conn)
+                    conn, opened_at = self._open()
+            except queue.Empty:
+                conn, opened_at = self._open()
+
+            try:
+                yield conn
+            except Exception:
+                # State unknown after an error; don't hand it to the next caller
+                self._close(conn)
+                raise
+            self._idle.put((conn, opened_at))
+        finally:
+            self._slots.release()
+
+    def close_all(self):
+        while True:
+            try:
+                conn, _ = self._idle.get_nowait()
+            except queue.Empty:
+                return
+            self._close(conn)
+
 class LDAPService:
     def __init__(self):
+        # Nothing connects until the first real AD call
+        self._pool = _ServiceConnectionPool(LDAP_POOL_SIZE, LDAP_POOL_LIFETIME_SECONDS)
+        # (AGENT_ONLY, USE_MOCK_LDAP) -> built tree
+        self._tree_cache = TTLCache(maxsize=4, ttl=TREE_CACHE_TTL_SECONDS)
+        self._tree_cache_lock = threading.Lock()
+        # Real AD: (monotonic build time, tree), refreshed in the background once expired
+        self._ad_tree: Optional[Tuple[float, Dict[str, Any]]] = None
+        self._ad_tree_refreshing = False
+        # lowercased hostname -> DN (or "Unknown"), shared by the threadpool workers
+        self._ou_cache = TTLCache(maxsize=10000, ttl=OU_CACHE_TTL_SECONDS)
+        self._ou_negative_cache = TTLCache(maxsize=10000, ttl=OU_NEGATIVE_CACHE_TTL_SECONDS)
+        self._ou_cache_lock = threading.Lock()
+
         self.mock_structure = {
             "id": "DC=example,DC=com",
             "name": "example.com",
@@ -51,6 +240,22 @@ class LDAPService:
                 }
             ]
         }
+        # Lowercased computer name -> DN, built once for mock resolve_machine_ou lookups
+        self._mock_computer_index: Dict[str, str] = {}
+        self._index_computers(self.mock_structure, self._mock_computer_index)
+
+    @staticmethod
+    def _index_computers(root: Dict[str, Any], index: Dict[str, str]):
+        # Iterative pre-order walk; children are pushed reversed so they pop in tree order
+        stack = [root]
+        while stack:
+            node = stack.pop()
+            if node.get("type") == "computer":
+                # setdefault: the first match in tree order wins, as the old per-call search did
+                index.setdefault(node["name"].lower(), node["id"])
+            children = node.get("children")
+            if children:
+                stack.extend(reversed(children))
 
     def verify_user(self, username, password):
         """Verifies credentials against AD. Returns status string."""
@@ -59,18 +264,15 @@ class LDAPService:
             return "SUCCESS" # In mock mode, any password works for 'admin' usually
             
         try:
-
-            from ldap3.core.exceptions import LDAPBindError
+            ldap3 = _load_ldap3()
 
             try:
-                server = Server(settings.AD_SERVER, get_info=ALL, connect_timeout=2)
-
                 # 1. Search for User DN
-                # Bind with service account first
-                with Connection(server, user=settings.AD_USER, password=settings.AD_PASSWORD, auto_bind=True) as conn:
+                # Pooled service account connection
+                with self._pool.connection() as conn:
                     conn.search(
                         settings.AD_BASE_DN,
-                        f"(&(objectClass=user)(sAMAccountName={escape_filter_chars(username)}))",
+                        f"(&(objectClass=user)(sAMAccountName={_escape_filter(username)}))",
                         attributes=["distinguishedName"],
                     )
                     if not conn.entries:
@@ -78,11 +280,25 @@ class LDAPService:
                     user_dn = str(conn.entries[0].distinguishedName)
 
                 # 2. Verify password by binding as that user
+                # The only new connection per login; it does nothing but bind and is unbound right away.
+                # Not a `with` block: auto_bind binds it on creation, and ldap3's __exit__ leaves
+                # a connection that was already bound on entry open.
                 # This raises LDAPBindError if password is wrong
-                with Connection(server, user=user_dn, password=password, auto_bind=True):
+                conn = ldap3.Connection(
+                    self._pool.server,
+                    user=user_dn,
+                    password=password,
+                    authentication=ldap3.SIMPLE,
+                    auto_bind=True,
+                    read_only=True,
+                    receive_timeout=2,
+                )
+                try:
                     return "SUCCESS"
+                finally:
+                    conn.unbind()
 
-            except LDAPBindError:
+            except ldap3.LDAPBindError:
                 return "INVALID_CREDENTIALS"
                  
         except Exception as e:
@@ -96,27 +312,31 @@ class LDAPService:
             return f"CN={escape_dn_chars(hostname)},OU=Agents,{settings.AD_BASE_DN}"
             
         if settings.USE_MOCK_LDAP:
-            # Search in mock structure
-            # Logic: Helper to traverse tree
-            def find_computer(node, name):
-                if node.get("type") == "computer" and node.get("name").lower() == name.lower():
-                    return node.get("id")
-                for child in node.get("children", []):
-                    res = find_computer(child, name)
-                    if res: return res
-                return None
-            
-            res = find_computer(self.mock_structure, hostname)
-            return res or "Unknown"
+            # Look up in the mock structure's index
+            return self._mock_computer_index.get(hostname.lower(), "Unknown")
+
+        # Real LDAP, answered from cache when the hostname was looked up recently
+        cache_key = hostname.lower()
+        with self._ou_cache_lock:
+            cached = self._ou_cache.get(cache_key) or self._ou_negative_cache.get(cache_key)
+        if cached is not None:
+            return cached
 
-        # Real LDAP
+        dn = self._search_machine_dn(hostname)
+        with self._ou_cache_lock:
+            if dn == "Unknown":
+                self._ou_negative_cache[cache_key] = dn
+            else:
+                self._ou_cache[cache_key] = dn
+        return dn
+
+    def _search_machine_dn(self, hostname: str) -> str:
         try:
-            server = Server(settings.AD_SERVER, get_info=ALL, connect_timeout=2)
-            with Connection(server, user=settings.AD_USER, password=settings.AD_PASSWORD, auto_bind=True) as conn:
+            with self._pool.connection() as conn:
                 # Search for computer
                 conn.search(
                     settings.AD_BASE_DN,
-                    f"(&(objectClass=computer)(name={escape_filter_chars(hostname)}))",
+                    f"(&(objectClass=computer)(name={_escape_filter(hostname)}))",
                     attributes=["distinguishedName"],
                 )
                 if conn.entries:
@@ -129,34 +349,118 @@ class LDAPService:
 
     def get_ou_tree(self, session: Optional[Session] = None) -> Dict[str, Any]:
         """Returns the full OU structure."""
-        if settings.AGENT_ONLY:
-            return self._build_agent_tree(session)
+        if settings.USE_MOCK_LDAP and not settings.AGENT_ONLY:
+            return self.mock_structure
+
+        if not settings.AGENT_ONLY:
+            return self._get_ad_tree()
 
+        cache_key = (settings.AGENT_ONLY, settings.USE_MOCK_LDAP)
+        with self._tree_cache_lock:
+            tree = self._tree_cache.get(cache_key)
+        if tree is not None:
+            return tree
+
+        tree = self._build_agent_tree(session)
+
+        # Error results are not cached so the next request retries
+        if "Error" not in tree:
+            with self._tree_cache_lock:
+                self._tree_cache[cache_key] = tree
+        return tree
+
+    def _get_ad_tree(self) -> Dict[str, Any]:
+        """Real AD tree, served from the last snapshot (stale-while-revalidate).
+
+        Walking the directory takes seconds on large domains, so once a snapshot exists
+        requests never wait for AD: an expired snapshot is still returned while a single
+        background thread rebuilds it. Only the very first call builds inline.
+        """
+        with self._tree_cache_lock:
+            snapshot = self._ad_tree
+        if snapshot is None:
+            return self._refresh_ad_tree()
+
+        built_at, tree = snapshot
+        if time.monotonic() - built_at >= AD_TREE_REFRESH_SECONDS:
+            self._start_ad_tree_refresh()
+        return tree
+
+    def _refresh_ad_tree(self, raise_errors: bool = False) -> Dict[str, Any]:
+        tree = self._fetch_real_ad_structure(raise_errors)
+        # A failed fetch keeps the previous snapshot; the error is only returned when there is none
+        if "Error" not in tree:
+            with self._tree_cache_lock:
+                self._ad_tree = (time.monotonic(), tree)
+        return tree
+
+    def _start_ad_tree_refresh(self):
+        with self._tree_cache_lock:
+            if self._ad_tree_refreshing:
+                return
+            self._ad_tree_refreshing = True
+
+        def run():
+            try:
+                self._refresh_ad_tree()
+            finally:
+                with self._tree_cache_lock:
+                    self._ad_tree_refreshing = False
+
+        threading.Thread(target=run, name="ad-tree-refresh", daemon=True).start()
+
+    # Async entry points for async endpoints: ldap3 is blocking, so the call runs in a worker
+    # thread (each with its own pooled connection) and the event loop keeps serving.
+    # Sync endpoints already run in the threadpool and call the blocking methods directly.
+
+    async def averify_user(self, username, password):
         if settings.USE_MOCK_LDAP:
-            return self.mock_structure
-        
-        return self._fetch_real_ad_structure()
+            return self.verify_user(username, password)
+        return await anyio.to_thread.run_sync(self.verify_user, username, password)
+
+    async def aresolve_machine_ou(self, hostname: str, session: Optional[Session] = None) -> str:
+        return await anyio.to_thread.run_sync(self.resolve_machine_ou, hostname, session)
+
+    def warmup(self):
+        """Bind the pooled service connection and build the first AD tree snapshot (application startup)."""
+        if settings.USE_MOCK_LDAP or settings.AGENT_ONLY:
+            return
+        try:
+            self._refresh_ad_tree(raise_errors=True)
+        except Exception:
+            # Not fatal: the first tree request retries and reports AD errors as usual
+            logger.warning("LDAP warmup failed, the AD tree will be fetched on first use.", exc_info=True)
+
+    def close(self):
+        """Unbind pooled AD connections (application shutdown)."""
+        self._pool.close_all()
+
+    def invalidate_tree_cache(self):
+        """Drop built trees after a machine was added, renamed or deleted."""
+        with self._tree_cache_lock:
+            self._tree_cache.clear()
 
     def _build_agent_tree(self, session: Optional[Session]) -> Dict[str, Any]:
         """Builds a virtual tree from registered agents."""
         if not session:
             return {"Error": {"type": "error", "name": "Database session required for Agent Only mode"}}
             
-        machines = session.exec(select(Machine)).all()
+        # Only the two columns the tree uses, streamed in batches
+        rows = session.exec(select(Machine.id, Machine.hostname).execution_options(yield_per=1000))
         
         # Helper to get domain parts
         root_dn = settings.AD_BASE_DN # Use configured base instead of hardcoded local
         root_name = root_dn.replace("DC=", "").replace(",", ".")
 
         children_nodes = []
-        for machine in machines:
+        for machine_id, hostname in rows:
 
-            machine_dn = f"CN={escape_dn_chars(machine.hostname)},OU=Agents,{root_dn}"
+            machine_dn = f"CN={escape_dn_chars(hostname)},OU=Agents,{root_dn}"
             # Use ID as string for key if needed, or DN
             children_nodes.append({
-                "name": machine.hostname,
+                "name": hostname,
                 "type": "computer",
-                "id": str(machine.id), # Frontend uses ID for selection
+                "id": str(machine_id), # Frontend uses ID for selection
                 "dn": machine_dn
             })
 
@@ -176,116 +480,67 @@ class LDAPService:
             
         return root_node
 
-    def _fetch_real_ad_structure(self) -> Dict[str, Any]:
-        """Connects to real AD and builds the tree."""
+    def _fetch_real_ad_structure(self, raise_errors: bool = False) -> Dict[str, Any]:
+        """Connects to real AD and builds the tree. Errors come back as an {"Error": ...} tree unless raise_errors."""
         try:
-            server = Server(settings.AD_SERVER, get_info=ALL, connect_timeout=2)
-
-            with Connection(
-                server,
-                user=settings.AD_USER,
-                password=settings.AD_PASSWORD,
-                auto_bind=True,
-                raise_exceptions=True,
-            ) as conn:
-                # Search for OUs and Computers
-                conn.search(settings.AD_BASE_DN, '(objectClass=organizationalUnit)', attributes=['distinguishedName', 'name'])
-                ous = [entry for entry in conn.entries]
-                
-                conn.search(settings.AD_BASE_DN, '(objectClass=computer)', attributes=['distinguishedName', 'name'])
-                computers = [entry for entry in conn.entries]
-            
-            # The connection is now closed, but we have the data in 'ous' and 'computers' lists
-
-            
-            # Build a hierarchical tree structure
-            
-            # Map all OUs by DN
-
-            ou_map = {}
-            for ou in ous:
-                ou_dn = str(ou.distinguishedName)
-                ou_map[ou_dn.lower()] = {
-                    "id": ou_dn,
-                    "name": str(ou.name),
-                    "type": "ou",
-                    "children": []
-                }
-            
             # Root node (Domain)
             root_dn = settings.AD_BASE_DN
+            root_dn_lower = root_dn.lower()
             root_node = {
                 "id": root_dn,
                 "name": root_dn.replace("DC=", "").replace(",", "."), # Simple name from DN
                 "type": "domain",
                 "children": []
             }
-            
-            # Helper to find parent DN
-            def get_parent_dn(dn):
-                try:
 
-                    parsed = parse_dn(dn)
-                    if len(parsed) > 1:
-                        # Reconstruct parent by skipping the first RDN
-                        parent_parts = []
-                        for i in range(1, len(parsed)):
-                            attr, val, sep = parsed[i]
-                            # We must re-escape special characters in the value
-                            # escape_dn_chars handles ',', '+', '"', '\', '<', '>', ';', etc.
-                            escaped_val = escape_dn_chars(val)
-                            parent_parts.append(f"{attr}={escaped_val}")
-
-                        return ",".join(parent_parts)
-                except Exception:
-                    pass
-                return None
-
-            # Attach OUs to their parents
-            for dn_key, node in ou_map.items():
-                # dn_key is lower cased
-                # node['id'] is original case
-                
-                parent_dn = get_parent_dn(node['id'])
-                if not parent_dn: 
-                    continue
-                    
-                parent_dn_lower = parent_dn.lower()
-                
-                if parent_dn_lower == root_dn.lower():
-                    root_node["children"].append(node)
-                elif parent_dn_lower in ou_map:
-                    ou_map[parent_dn_lower]["children"].append(node)
-                else:
-                    # Parent might be a container we didn't fetch or it's out of scope
-                    # For safety, add to root or ignore. Let's add to root to be safe.
-                    if parent_dn_lower != root_dn.lower(): 
-                        root_node["children"].append(node)
-
-            # Attach Computers to their OUs
-            for comp in computers:
-                comp_dn = str(comp.distinguishedName)
-                comp_name = str(comp.name)
-                parent_dn = get_parent_dn(comp_dn)
-                
-                comp_node = {"id": comp_dn, "name": comp_name, "type": "computer"}
-                
-                if not parent_dn:
-                    root_node["children"].append(comp_node)
-                    continue
-
-                parent_dn_lower = parent_dn.lower()
-
-                if parent_dn_lower == root_dn.lower():
-                    root_node["children"].append(comp_node)
-                elif parent_dn_lower in ou_map:
-                    ou_map[parent_dn_lower]["children"].append(comp_node)
+            # Build the hierarchy in one pass: every node goes into its parent's child list
+            # as it is read, keyed by the lowercased parent DN
+            ou_map = {}
+            children_of = defaultdict(list)
+
+            # One paged pass for OUs and computers. With the generator each page is
+            # decoded as it arrives instead of materializing ldap3 Entry objects.
+            with self._pool.connection() as conn:
+                results = conn.extend.standard.paged_search(
+                    search_base=settings.AD_BASE_DN,
+                    search_filter='(|(objectClass=organizationalUnit)(objectClass=computer))',
+                    attributes=['distinguishedName', 'name', 'objectClass'],
+                    paged_size=AD_PAGE_SIZE,
+                    generator=True,
+                )
+                for entry in results:
+                    if entry.get("type") != "searchResEntry":
+                        continue # Referrals
+                    attrs = entry["attributes"]
+                    classes = {c.lower() for c in attrs.get("objectClass", ())}
+                    dn = _first_value(attrs.get("distinguishedName")) or entry["dn"]
+                    name = _first_value(attrs.get("name"))
+                    parent_dn = _parent_of(dn)
+
+                    if "organizationalunit" in classes:
+                        node = {"id": dn, "name": name, "type": "ou", "children": []}
+                        ou_map[dn.lower()] = node
+                        if parent_dn:
+                            children_of[parent_dn.lower()].append(node)
+                    elif "computer" in classes:
+                        node = {"id": dn, "name": name, "type": "computer"}
+                        children_of[parent_dn.lower() if parent_dn else root_dn_lower].append(node)
+
+            # Stitch child lists onto their OUs
+            root_children = root_node["children"]
+            for parent_dn_lower, children in children_of.items():
+                if parent_dn_lower != root_dn_lower and parent_dn_lower in ou_map:
+                    ou_map[parent_dn_lower]["children"] = children
                 else:
-                    root_node["children"].append(comp_node)
-            
+                    # Directly under the domain, or the parent is a container we didn't fetch / out of scope.
+                    # For safety, add to root.
+                    root_children.extend(children)
+
             return root_node
             
         except Exception as e:
+            if raise_errors:
+                raise
             print(f"LDAP Error: {e}")
             return {"Error": {"type": "error", "name": str(e)}}
 
@@ -1,14 +1,19 @@
-from sqlmodel import Session, select
-from database import engine
+from sqlmodel import select, func
+from database import session_scope
 from models import Deployment, Software
 
 def list_deployments():
-    with Session(engine) as session:
-        deployments = session.exec(select(Deployment)).all()
-        print(f"Found {len(deployments)} deployments:")
-        for d in deployments:
-            soft_name = d.software.name if d.software else "UNKNOWN"
-            print(f"ID: {d.id} | Software: {soft_name} | Target Type: {d.target_type} | Target Value: {d.target_value}")
+    with session_scope() as session:
+        count = session.exec(select(func.count()).select_from(Deployment)).one()
+        print(f"Found {count} deployments:")
+        # Software name joined in SQL instead of a lazy load per deployment; only the printed columns
+        rows = session.exec(
+            select(Deployment.id, Software.name, Deployment.target_type, Deployment.target_value)
+            .outerjoin(Software, Deployment.software_id == Software.id)
+            .execution_options(yield_per=1000)
+        )
+        for deployment_id, soft_name, target_type, target_value in rows:
+            print(f"ID: {deployment_id} | Software: {soft_name or 'UNKNOWN'} | Target Type: {target_type} | Target Value: {target_value}")
 
 if __name__ == "__main__":
     list_deployments()
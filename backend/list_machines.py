@@ -1,13 +1,17 @@
-from sqlmodel import Session, select
-from database import engine
+from sqlmodel import select, func
+from database import session_scope
 from models import Machine
 
 def list_machines():
-    with Session(engine) as session:
-        machines = session.exec(select(Machine)).all()
-        print(f"Found {len(machines)} machines:")
-        for m in machines:
-            print(f"ID: {m.id} | Hostname: {m.hostname} | MAC: {m.mac_address} | OU: {m.ou_path}")
+    with session_scope() as session:
+        count = session.exec(select(func.count()).select_from(Machine)).one()
+        print(f"Found {count} machines:")
+        # Only the printed columns, streamed in batches instead of loaded up front
+        rows = session.exec(
+            select(Machine.id, Machine.hostname, Machine.mac_address, Machine.ou_path).execution_options(yield_per=1000)
+        )
+        for machine_id, hostname, mac_address, ou_path in rows:
+            print(f"ID: {machine_id} | Hostname: {hostname} | MAC: {mac_address} | OU: {ou_path}")
 
 if __name__ == "__main__":
     list_machines()
@@ -0,0 +1,109 @@
+import asyncio
+import logging
+from collections import Counter
+from typing import Any, Dict, List, Optional
+
+from sqlalchemy import insert
+from sqlmodel.ext.asyncio.session import AsyncSession
+from database import async_engine
+from models import AgentLog
+
+logger = logging.getLogger(__name__)
+
+# Agent log lines are written in batches: one INSERT ... executemany and one commit
+# per batch instead of a transaction (and fsync) per line.
+LOG_QUEUE_MAXSIZE = 100_000
+LOG_BATCH_SIZE = 500
+LOG_FLUSH_INTERVAL_SECONDS = 1.0
+# A failed batch (usually "database is locked") is retried with doubling delays, ~15s in total,
+# before it is given up. Meanwhile the queue keeps filling and log() answers 503 once it is full.
+LOG_WRITE_ATTEMPTS = 5
+LOG_RETRY_DELAY_SECONDS = 1.0
+
+_queue: Optional[asyncio.Queue] = None
+_writer: Optional[asyncio.Task] = None
+
+# Lines accepted but not yet committed, per machine, so the per-minute rate limit still sees them
+_pending = Counter()
+
+def pending_count(machine_id: int) -> int:
+    return _pending[machine_id]
+
+def enqueue(row: Dict[str, Any]) -> bool:
+    """Queue one AgentLog row (machine_id, timestamp, level, message).
+
+    False if the writer isn't running; raises asyncio.QueueFull when the database has fallen behind.
+    """
+    if _queue is None:
+        return False
+    _queue.put_nowait(row)
+    _pending[row["machine_id"]] += 1
+    return True
+
+async def _write_batch(rows: List[Dict[str, Any]]):
+    try:
+        for attempt in range(1, LOG_WRITE_ATTEMPTS + 1):
+            try:
+                async with AsyncSession(async_engine) as session:
+                    await session.exec(insert(AgentLog), params=rows)
+                    await session.commit()
+                return
+            except Exception as e:
+                # The agents were already told these lines were accepted
+                if attempt == LOG_WRITE_ATTEMPTS:
+                    logger.error("Dropping %d agent log lines after %d failed writes: %s", len(rows), attempt, e)
+                    return
+                delay = LOG_RETRY_DELAY_SECONDS * 2 ** (attempt - 1)
+                logger.warning("Failed to write %d agent log lines, retrying in %gs: %s", len(rows), delay, e)
+                await asyncio.sleep(delay)
+    finally:
+        for row in rows:
+            mid = row["machine_id"]
+            _pending[mid] -= 1
+            if _pending[mid] <= 0:
+                del _pending[mid]
+
+async def _drain(queue: asyncio.Queue):
+    loop = asyncio.get_running_loop()
+    while True:
+        row = await queue.get()
+        if row is None:
+            return
+        rows = [row]
+        stopping = False
+        # Collect up to a full batch, waiting at most one flush interval after the first line
+        deadline = loop.time() + LOG_FLUSH_INTERVAL_SECONDS
+        while len(rows) < LOG_BATCH_SIZE:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                row = await asyncio.wait_for(queue.get(), timeout)
+            except asyncio.TimeoutError:
+                break
+            if row is None:
+                stopping = True
+                break
+            rows.append(row)
+        await _write_batch(rows)
+        if stopping:
+            return
+
+def start():
+    global _queue, _writer
+    if _writer is not None:
+        return
+    _queue = asyncio.Queue(maxsize=LOG_QUEUE_MAXSIZE)
+    _writer = asyncio.create_task(_drain(_queue))
+
+async def stop():
+    """Stop accepting lines and wait for the writer to commit what is already queued."""
+    global _queue, _writer
+    if _writer is None:
+        return
+    queue, writer = _queue, _writer
+    _queue = None
+    # Lines queued before the sentinel are written first
+    await queue.put(None)
+    await writer
+    _writer = None
@@ -1,11 +1,79 @@
+import asyncio
+import logging
+import logging.handlers
+import queue
+from contextlib import asynccontextmanager
 from fastapi import FastAPI
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
-from database import create_db_and_tables
+from fastapi.middleware.gzip import GZipMiddleware
+from database import async_engine, create_db_and_tables
+from responses import ORJSONResponse
+import log_queue
+import last_seen_writer
+import ack_writer
 from routers import management, agent, auth
 
 from config import settings
 
-app = FastAPI(title="ZE-SilentSync Manager", version="0.1.0")
+logger = logging.getLogger(__name__)
+
+def _configure_logging():
+    """Send log records through a queue so request handlers never block on stdout.
+
+    Returns the (handler, listener) pair to remove at shutdown, or None when the host process
+    (or an earlier app start) already configured the root logger.
+    """
+    root = logging.getLogger()
+    if root.handlers:
+        return None
+    # LOG_LEVEL comes from the environment or secrets.env; an unknown name falls back to INFO
+    level = settings.LOG_LEVEL.strip().upper()
+    valid_level = isinstance(logging.getLevelName(level), int)
+    root.setLevel(level if valid_level else logging.INFO)
+
+    records = queue.SimpleQueue()
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+    listener = logging.handlers.QueueListener(records, stream_handler, respect_handler_level=True)
+    queue_handler = logging.handlers.QueueHandler(records)
+    root.addHandler(queue_handler)
+    listener.start()
+    if not valid_level:
+        logger.warning("Unknown LOG_LEVEL %r, using INFO.", settings.LOG_LEVEL)
+    return queue_handler, listener
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    from ldap_service import ldap_service
+
+    logging_setup = _configure_logging()
+
+    # Seeding needs the tables; the AD bind doesn't, so it overlaps with both
+    async def prepare_db():
+        await run_in_threadpool(create_db_and_tables)
+        await run_in_threadpool(seed_data)
+
+    await asyncio.gather(prepare_db(), run_in_threadpool(ldap_service.warmup))
+    log_queue.start()
+    last_seen_writer.start()
+    ack_writer.start()
+    try:
+        yield
+    finally:
+        # Commit agent log lines, last_seen stamps and task acks still pending before the process exits
+        await log_queue.stop()
+        await last_seen_writer.stop()
+        await ack_writer.stop()
+        # The agent endpoints' aiosqlite connections each own a thread; close them on the loop that opened them
+        await async_engine.dispose()
+        ldap_service.close()
+        if logging_setup is not None:
+            queue_handler, listener = logging_setup
+            logging.getLogger().removeHandler(queue_handler)
+            listener.stop()
+
+app = FastAPI(title="ZE-SilentSync Manager", version="0.1.0", default_response_class=ORJSONResponse, lifespan=lifespan)
 
 # CORS Configuration
 origins = settings.ALLOWED_ORIGINS
@@ -18,42 +86,44 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-@app.on_event("startup")
-def on_startup():
-    create_db_and_tables()
-    seed_data()
+class _GZipMiddleware(GZipMiddleware):
+    """Installers under /static are already compressed and may be requested by byte range."""
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and scope["path"].startswith("/static/"):
+            await self.app(scope, receive, send)
+            return
+        await super().__call__(scope, receive, send)
+
+# The OU tree and machine lists are repetitive JSON; small responses skip compression
+app.add_middleware(_GZipMiddleware, minimum_size=1024, compresslevel=5)
 
 def seed_data():
     from sqlmodel import Session, select
     from database import engine
-    from models import Software, Machine
+    from models import Software, Machine, Admin
     
+    # One session and one transaction; both existence checks go out as a single SELECT EXISTS(...), EXISTS(...)
     with Session(engine) as session:
-        if not session.exec(select(Software)).first():
+        has_software, has_admin = session.exec(select(select(Software.id).exists(), select(Admin.id).exists())).one()
+
+        if not has_software:
             print("Seeding Mock Software...")
-            softwares = [
+            session.add_all([
                 Software(name="Google Chrome", version="120.0", download_url="https://dl.google.com/chrome/install/chrome_installer.exe", silent_args="/silent /install", is_msi=False),
                 Software(name="Mozilla Firefox", version="121.0", download_url="https://download.mozilla.org/?product=firefox-msi-latest", silent_args="/qn", is_msi=True),
                 Software(name="7-Zip", version="23.01", download_url="https://www.7-zip.org/a/7z2301-x64.msi", silent_args="/qn", is_msi=True),
                 Software(name="VLC Media Player", version="3.0.20", download_url="https://get.videolan.org/vlc/3.0.20/win64/vlc-3.0.20-win64.exe", silent_args="/S", is_msi=False),
-            ]
-            for s in softwares:
-                session.add(s)
+            ])
             
             # Seed a Mock Machine for testing
 
             # if not session.exec(select(Machine)).first():
             #      session.add(Machine(hostname="TEST-PC-01", mac_address="00:11:22:33:44:55", os_info="Windows 11 Pro", ou_path="OU=Sales,DC=example,DC=com"))
-            
-            session.commit()
 
-    # Seed Default Admin
-    from models import Admin
-    from auth import get_password_hash
-    from config import settings
-    
-    with Session(engine) as session:
-        if not session.exec(select(Admin)).first():
+        # Seed Default Admin
+        if not has_admin:
+            from auth import get_password_hash
 
             password = settings.ADMIN_PASSWORD
             
@@ -74,18 +144,54 @@ def seed_data():
                 role="superadmin"
             )
             session.add(admin)
+
+        # Software and admin go in together
+        if not (has_software and has_admin):
             session.commit()
-            print("Default admin created.")
+            if not has_admin:
+                print("Default admin created.")
 
-from fastapi.staticfiles import StaticFiles
 import os
+import stat
+from fastapi import HTTPException, Request, Response
+from fastapi.responses import FileResponse
 
 app.include_router(auth.router)
 app.include_router(management.router)
 app.include_router(agent.router)
 
 os.makedirs("uploads", exist_ok=True)
-app.mount("/static", StaticFiles(directory="uploads"), name="static")
+UPLOAD_ROOT = os.path.realpath("uploads")
+
+def _etag_matches(if_none_match: str, etag: str) -> bool:
+    for candidate in if_none_match.split(","):
+        candidate = candidate.strip()
+        if candidate == "*" or candidate.removeprefix("W/") == etag:
+            return True
+    return False
+
+@app.api_route("/static/{path:path}", methods=["GET", "HEAD"], include_in_schema=False)
+def serve_upload(path: str, request: Request):
+    """Uploaded installers. One stat per request, reused for the ETag and the response headers.
+
+    Agents re-downloading an unchanged installer get a 304; Range requests are served by FileResponse.
+    """
+    full_path = os.path.realpath(os.path.join(UPLOAD_ROOT, path))
+    if os.path.commonpath([full_path, UPLOAD_ROOT]) != UPLOAD_ROOT:
+        raise HTTPException(status_code=404, detail="Not Found")
+    try:
+        st = os.stat(full_path)
+    except OSError:
+        raise HTTPException(status_code=404, detail="Not Found")
+    if not stat.S_ISREG(st.st_mode):
+        raise HTTPException(status_code=404, detail="Not Found")
+
+    # Changes whenever the file is replaced or rewritten
+    etag = f'"{st.st_mtime_ns:x}-{st.st_size:x}"'
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match and _etag_matches(if_none_match, etag):
+        return Response(status_code=304, headers={"ETag": etag})
+    return FileResponse(full_path, stat_result=st, headers={"ETag": etag})
 
 @app.get("/")
 def read_root():
@@ -1,13 +1,14 @@
 from typing import Optional, List
 from datetime import datetime, timezone
 from sqlmodel import Field, SQLModel, Relationship
-from sqlalchemy import UniqueConstraint
+from sqlalchemy import UniqueConstraint, Index, func
 
 
 # --- Join Tables ---
 class MachineSoftwareLink(SQLModel, table=True):
     machine_id: Optional[int] = Field(default=None, foreign_key="machine.id", primary_key=True)
-    software_id: Optional[int] = Field(default=None, foreign_key="software.id", primary_key=True)
+    # The (machine_id, software_id) primary key serves per-machine lookups; this serves per-software cleanup
+    software_id: Optional[int] = Field(default=None, foreign_key="software.id", primary_key=True, index=True)
     status: str = Field(default="pending") # pending, installing, installed, failed
     installed_version: Optional[str] = None
     last_updated: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
@@ -86,7 +87,7 @@ class Deployment(SQLModel, table=True):
     """
     id: Optional[int] = Field(default=None, primary_key=True)
     machine_id: Optional[int] = Field(default=None, foreign_key="machine.id")
-    software_id: Optional[int] = Field(default=None, foreign_key="software.id")
+    software_id: Optional[int] = Field(default=None, foreign_key="software.id", index=True)
     
     target_type: str = Field(default="machine") # machine, ou, group
     target_value: str # machine_id or OU DN
@@ -101,6 +102,11 @@ class Deployment(SQLModel, table=True):
     machine: Optional[Machine] = Relationship(back_populates="deployments")
     software: Optional[Software] = Relationship(back_populates="deployments")
 
+# Heartbeat lookups: exact machine targets, and a case-insensitive match on OU target DNs.
+# Declared after the class because the expression needs the mapped column.
+Index("ix_deployment_type_value", Deployment.target_type, Deployment.target_value)
+Index("ix_deployment_type_value_lower", Deployment.target_type, func.lower(Deployment.target_value))
+
 class AuditLog(SQLModel, table=True):
     id: Optional[int] = Field(default=None, primary_key=True)
     admin_id: Optional[int] = Field(default=None, foreign_key="admin.id")
@@ -0,0 +1,11 @@
+import orjson
+from fastapi.responses import JSONResponse
+
+class ORJSONResponse(JSONResponse):
+    """JSON rendered by orjson: large payloads like the AD tree serialize in C.
+
+    Kept local because fastapi.responses.ORJSONResponse is deprecated in newer FastAPI.
+    """
+
+    def render(self, content) -> bytes:
+        return orjson.dumps(content, option=orjson.OPT_NON_STR_KEYS)
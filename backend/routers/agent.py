@@ -1,18 +1,53 @@
 from fastapi import APIRouter, Depends, HTTPException, Request
-from sqlmodel import Session, select, or_
-from sqlalchemy.orm import joinedload
+from sqlmodel import Session, select, or_, func
+from sqlalchemy import bindparam, case, event, inspect
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.orm import Session as SASession, aliased, joinedload
 from datetime import datetime, timedelta, timezone
-from database import get_session
-from models import Machine, Deployment, Software, AgentLog
+from database import get_async_session
+from sqlmodel.ext.asyncio.session import AsyncSession
+from models import Machine, Deployment, Software, AgentLog, MachineSoftwareLink
 from auth import verify_agent_token
+from responses import ORJSONResponse
+import log_queue
+import last_seen_writer
+import ack_writer
+from ack_writer import LINK_UPSERT
+import asyncio
+import logging
 import secrets
 import re
 import threading
+from itertools import chain
+from functools import lru_cache
+from dataclasses import dataclass
+from typing import Annotated, Optional
+import msgspec
+from types import SimpleNamespace
+from cachetools import TTLCache
 from config import settings
+from ldap_service import ldap_service, ou_suffixes
+
+# Per-heartbeat tracing goes to logger.debug; shown with LOG_LEVEL=DEBUG
+logger = logging.getLogger(__name__)
 
 # Thread Safety Lock for Rate Limiters
 _rate_limit_lock = threading.Lock()
 
+# last_seen is only rewritten once it is this old, so a steady heartbeat doesn't UPDATE the row every time.
+# Well below the dashboard's 5 minute online threshold.
+LAST_SEEN_WRITE_INTERVAL = timedelta(seconds=60)
+
+def _as_utc(value: datetime) -> datetime:
+    # SQLite hands DateTime columns back naive; they are stored as UTC
+    return value.replace(tzinfo=timezone.utc) if value.tzinfo is None else value
+
+def _last_seen_is_stale(last_seen: datetime, now: datetime) -> bool:
+    if last_seen is None:
+        return True
+    return now - _as_utc(last_seen) >= LAST_SEEN_WRITE_INTERVAL
+
 def get_client_ip(req: Request) -> str:
     """
     Robust client IP extraction.
@@ -38,16 +73,388 @@ router = APIRouter(prefix="/api/v1/agent", tags=["agent"], dependencies=[Depends
 
 from pydantic import BaseModel, Field
 
-class HeartbeatRequest(BaseModel):
-    hostname: str = Field(..., max_length=255)
-    mac_address: str = Field(..., max_length=17)
-    os_info: str = Field(..., max_length=100)
+# Hot-path statements, built once so only the bound values change per request
+MACHINE_BY_MAC = select(Machine).where(Machine.mac_address == bindparam("mac_address"))
+MACHINE_BY_HOSTNAME = select(Machine).where(Machine.hostname == bindparam("hostname"))
+# Existence check only: answered from the unique hostname index without touching the table
+MACHINE_ID_BY_HOSTNAME = select(Machine.id).where(Machine.hostname == bindparam("hostname"))
+# Registration: one INSERT that yields nothing (instead of an IntegrityError and a rollback) when the same
+# MAC was registered concurrently. A taken hostname still raises and goes through the collision recovery.
+MACHINE_REGISTER = sqlite_insert(Machine).values(
+    hostname=bindparam("hostname"),
+    mac_address=bindparam("mac_address"),
+    os_info=bindparam("os_info"),
+    last_seen=bindparam("last_seen"),
+    ou_path=bindparam("ou_path"),
+    api_key=bindparam("api_key"),
+).on_conflict_do_nothing(index_elements=[Machine.mac_address]).returning(Machine)
+# Precedence between deployments of the same software: newest first, then machine targets before OU targets
+_DEPLOYMENT_PRECEDENCE = (Deployment.created_at.desc(), case((Deployment.target_type == "machine", 0), else_=1))
+# Only the deciding deployment per software survives, so duplicates are never hydrated
+_ranked_deployments = select(
+    Deployment,
+    func.row_number().over(partition_by=Deployment.software_id, order_by=_DEPLOYMENT_PRECEDENCE).label("rank"),
+).where(
+    or_(
+        (Deployment.target_type == "machine") & (Deployment.target_value.in_(bindparam("machine_values", expanding=True))),
+        # DNs compare case-insensitively; served by the lower(target_value) expression index
+        (Deployment.target_type == "ou") & (func.lower(Deployment.target_value).in_(bindparam("ou_dns", expanding=True)))
+    ),
+    # Expired deployments never apply again, so they are dropped here (and can't outrank a live one).
+    # A future schedule_start is still checked per heartbeat: cached candidates must pick it up once it opens.
+    or_(Deployment.schedule_end.is_(None), Deployment.schedule_end >= bindparam("now")),
+).subquery()
+_RankedDeployment = aliased(Deployment, _ranked_deployments)
+# Every task needs its software's columns, so they are joined onto the deployment rows: one round-trip.
+# Deployments without a software row never produce a task and are left out by the inner join.
+DEPLOYMENTS_FOR_TARGETS = (
+    select(_RankedDeployment, Software)
+    .join(Software, _RankedDeployment.software_id == Software.id)
+    .where(_ranked_deployments.c.rank == 1)
+    .order_by(_RankedDeployment.created_at.desc(), case((_RankedDeployment.target_type == "machine", 0), else_=1))
+    # Fetched in chunks: the loader snapshots rows as they arrive instead of materializing them all first
+    .execution_options(yield_per=256)
+)
+LINKS_FOR_SOFTWARE = select(MachineSoftwareLink).where(
+    (MachineSoftwareLink.machine_id == bindparam("machine_id")) &
+    (MachineSoftwareLink.software_id.in_(bindparam("software_ids", expanding=True)))
+)
+RECENT_LOG_COUNT = select(func.count()).where(
+    (AgentLog.machine_id == bindparam("machine_id")) &
+    (AgentLog.timestamp > bindparam("cutoff"))
+)
+
+# --- Deployment candidate cache ---
+# Per machine id: the deployments that target it (sorted) and its software links, as detached snapshots,
+# i.e. an in-memory view of "which tasks could apply to machine X".
+# Entries carry the change counter they were built under; any committed insert/update/delete of a
+# Deployment or Software bumps it and so retires every entry. A committed link change only drops the
+# entries of the machines it belongs to: acks write links constantly and must not flush the whole fleet.
+# The TTL bounds staleness from writes this process doesn't see (scripts, other workers).
+# Schedule and retry windows are still checked per heartbeat.
+DEPLOYMENT_CACHE_TTL_SECONDS = 30
+_deployment_cache = TTLCache(maxsize=10000, ttl=DEPLOYMENT_CACHE_TTL_SECONDS)
+_deployment_cache_lock = threading.Lock()
+_deployment_version = 0
+# Bumped on every committed link change; a fill that overlapped one isn't stored
+_link_version = 0
+
+_DEPLOYMENT_STATE_MODELS = (Deployment, Software)
+
+# --- Resolved task memo ---
+# Per machine id: (candidate list it was resolved from, valid_until, tasks). Reused while the machine's
+# cached candidates are the very same objects (any deployment, software or link change replaces them)
+# and no schedule or retry boundary has passed.
+TASK_CACHE_TTL_SECONDS = 15
+_task_cache = TTLCache(maxsize=10000, ttl=TASK_CACHE_TTL_SECONDS)
+
+# --- Machine identity cache ---
+# mac_address -> the Machine fields ack and log check, so those endpoints skip the Machine SELECT.
+# An entry is dropped when a commit inserts, deletes or changes one of these fields on that machine;
+# the TTL bounds staleness from writes this process doesn't see. That includes the api_key checked for
+# auth: a heartbeat handled by another worker can rotate it, so entries live only a few seconds. That
+# still absorbs an agent's ack/log bursts, and a rotated key is honoured everywhere almost at once.
+MACHINE_CACHE_TTL_SECONDS = 5
+_MACHINE_IDENTITY_FIELDS = ("id", "hostname", "ou_path", "api_key", "ip_address")
+_machine_cache = TTLCache(maxsize=50000, ttl=MACHINE_CACHE_TTL_SECONDS)
+_machine_cache_lock = threading.Lock()
+_machine_cache_version = 0
+
+MACHINE_IDENTITY_BY_MAC = select(*(getattr(Machine, f) for f in _MACHINE_IDENTITY_FIELDS)).where(
+    Machine.mac_address == bindparam("mac_address")
+)
+
+def _identity_changed(machine: Machine) -> bool:
+    state = inspect(machine)
+    return any(state.attrs[f].history.has_changes() for f in _MACHINE_IDENTITY_FIELDS)
+
+@event.listens_for(SASession, "after_flush")
+def _note_deployment_changes(session, flush_context):
+    # after_flush still sees the pre-flush new/dirty/deleted sets and attribute history
+    for obj in chain(session.new, session.dirty, session.deleted):
+        if isinstance(obj, _DEPLOYMENT_STATE_MODELS):
+            session.info["deployments_changed"] = True
+        elif isinstance(obj, MachineSoftwareLink):
+            session.info.setdefault("links_changed", set()).add(obj.machine_id)
+        elif isinstance(obj, Machine):
+            # A heartbeat re-sets every field; only real changes to what ack/log check count
+            if obj in session.dirty and not _identity_changed(obj):
+                continue
+            session.info.setdefault("machines_changed", set()).add(obj.mac_address)
+
+@event.listens_for(SASession, "after_commit")
+def _bump_deployment_version(session):
+    # Bumped after the commit, so a heartbeat that sees the new counter also sees the new rows
+    if session.info.pop("deployments_changed", False):
+        global _deployment_version
+        with _deployment_cache_lock:
+            _deployment_version += 1
+    changed_links = session.info.pop("links_changed", None)
+    if changed_links:
+        global _link_version
+        with _deployment_cache_lock:
+            _link_version += 1
+            for machine_id in changed_links:
+                _deployment_cache.pop(machine_id, None)
+    changed_macs = session.info.pop("machines_changed", None)
+    if changed_macs:
+        global _machine_cache_version
+        with _machine_cache_lock:
+            _machine_cache_version += 1
+            for mac in changed_macs:
+                _machine_cache.pop(mac, None)
+
+@event.listens_for(SASession, "after_soft_rollback")
+def _discard_deployment_changes(session, previous_transaction):
+    session.info.pop("deployments_changed", None)
+    session.info.pop("links_changed", None)
+    session.info.pop("machines_changed", None)
+
+async def _get_machine_identity(session: AsyncSession, mac_address: str):
+    """Cached (id, hostname, ou_path, api_key, ip_address) for a MAC, or None if no machine has it."""
+    with _machine_cache_lock:
+        version = _machine_cache_version
+        cached = _machine_cache.get(mac_address)
+    if cached is not None:
+        return cached
+
+    row = (await session.exec(MACHINE_IDENTITY_BY_MAC, params={"mac_address": mac_address})).first()
+    if row is None:
+        return None
+    identity = SimpleNamespace(**row._asdict())
+    with _machine_cache_lock:
+        # A machine committed while we were reading may have been read in its old state
+        if _machine_cache_version == version:
+            _machine_cache[mac_address] = identity
+    return identity
+
+def _snapshot(row):
+    return SimpleNamespace(**row.model_dump())
+
+@lru_cache(maxsize=50000)
+def _ou_match_set(ou_path: str) -> frozenset:
+    """Lowercased DNs an OU target can equal to cover a machine at ou_path: the DN itself and every parent.
+
+    Set membership gives the same answer as the endswith/boundary check without case-folding per deployment.
+    """
+    dn = ou_path.lower()
+    return frozenset([dn, *ou_suffixes(dn)])
+
+async def _get_deployment_candidates(session: AsyncSession, machine: Machine):
+    # The targeting inputs are stored with the entry: a rename or OU move makes it a miss
+    targeting = (machine.hostname, machine.ou_path)
+    with _deployment_cache_lock:
+        version = _deployment_version
+        link_version = _link_version
+        cached = _deployment_cache.get(machine.id)
+    if cached is not None and cached[0] == version and cached[1] == targeting:
+        return cached[2], cached[3]
+
+    # The loader is plain ORM code; run_sync hands it the sync session behind the async one
+    deployments, links = await session.run_sync(_load_deployment_candidates, machine)
+
+    with _deployment_cache_lock:
+        # A link committed during the load may have been read in its old state
+        if _link_version == link_version:
+            _deployment_cache[machine.id] = (version, targeting, deployments, links)
+    return deployments, links
+
+def _load_deployment_candidates(session: Session, machine: Machine):
+    """Snapshots of the deployments targeting the machine (with .software), newest first, and of its links by software_id."""
+    # Optimization: Filter IN SQL
+    
+    # Calculate parent OUs for OU targeting
+    # e.g. CN=PC1,OU=Sales,DC=example,DC=com -> [OU=Sales,DC=example,DC=com, DC=example,DC=com, ...]
+    parent_ous = []
+    if machine.ou_path and machine.ou_path != "Unknown":
+        parent_ous = ou_suffixes(machine.ou_path)
+    
+    # Deployment Target Values we care about:
+    # 1. Machine ID
+    # 2. Hostname
+    # 3. CN=Hostname (prefix)
+    # 4. Any parent OU
+    
+    target_machine_values = [str(machine.id), machine.hostname, f"CN={machine.hostname}"]
+    
+    # One deployment per software, already in priority order:
+    # 1. By created_at (newest first) - so latest action (install/uninstall) takes precedence
+    # 2. By target_type - Machine (specific) over OU (general)
+    # Snapshotted as they stream in; the ORM objects aren't kept as a list next to their snapshots
+    rows = session.exec(DEPLOYMENTS_FOR_TARGETS, params={
+        "machine_values": target_machine_values,
+        "ou_dns": [dn.lower() for dn in parent_ous],
+        "now": datetime.now(timezone.utc),
+    })
+    deployments = []
+    for dep, software in rows:
+        snapshot = _snapshot(dep)
+        snapshot.software = _snapshot(software)
+        # Case-folded once per cache fill instead of on every heartbeat
+        snapshot.target_value_norm = dep.target_value.lower() if dep.target_value else ""
+        deployments.append(snapshot)
+    
+    # Fetch all links at once
+    dep_software_ids = [dep.software_id for dep in deployments]
+    existing_links = session.exec(LINKS_FOR_SOFTWARE, params={"machine_id": machine.id, "software_ids": dep_software_ids})
+    # Map by software_id
+    links_map = {link.software_id: _snapshot(link) for link in existing_links}
+    return deployments, links_map
+
+@dataclass(slots=True)
+class AgentTask:
+    """One task in the heartbeat response. orjson serializes slotted dataclasses natively, so no per-task dict."""
+    id: int
+    type: str  # install or uninstall
+    software_name: str
+    download_url: Optional[str]
+    silent_args: Optional[str]
+    is_msi: bool
+
+def _resolve_tasks(machine: Machine, potential_deployments, links_map, now: datetime):
+    """The tasks to send a machine now, and the time until which that answer holds.
+
+    The answer only changes with the candidates (new snapshot objects on any change) or when a
+    schedule start/end or a failed-task retry window passes.
+    """
+    tasks = []
+    valid_until = now + timedelta(seconds=TASK_CACHE_TTL_SECONDS)
+
+    machine_id_value = str(machine.id)
+    hostname_lower = machine.hostname.lower()
+    cn_prefix = f"cn={hostname_lower}"
+    ou_match = _ou_match_set(machine.ou_path) if machine.ou_path else frozenset()
+
+    # Deduplication by software happens in SQL: at most one deployment per software arrives here
+    for dep in potential_deployments:
+        is_target = False
+        
+        # Target Check
+        if dep.target_type == "machine":
+            # Check ID Match (strict) OR Hostname Match (loose) OR DN Match (loose)
+            # The backend might store just ID, or DN.
+            if dep.target_value == machine_id_value:
+                is_target = True
+            elif dep.target_value_norm == hostname_lower:
+                 is_target = True
+            elif dep.target_value_norm.startswith(cn_prefix):
+                 # Check if it is exact match or comma follows (to avoid prefix matching like PC1 matching PC10)
+                 val = dep.target_value_norm
+                 if val == cn_prefix or val.startswith(cn_prefix + ","):
+                     is_target = True
+                 
+        # Robust OU matching (OU deployments, and machine deployments addressed by DN)
+        # e.g. target="cn=computers,dc=local" and machine="cn=pc1,cn=computers,dc=local"
+        if not is_target and dep.target_value_norm in ou_match:
+            is_target = True
+    
+        if not is_target:
+            # logger.debug("Dep %s skipped. Not target. (Type: %s, Val: %s)", dep.id, dep.target_type, dep.target_value)
+            continue
+    
+        # Schedule Check
+        if dep.schedule_start and now < _as_utc(dep.schedule_start):
+            logger.debug("Dep %s skipped. Schedule start future.", dep.id)
+            valid_until = min(valid_until, _as_utc(dep.schedule_start))
+            continue
+        if dep.schedule_end and now > _as_utc(dep.schedule_end):
+            logger.debug("Dep %s skipped. Schedule end passed.", dep.id)
+            continue
+        if dep.schedule_end:
+            valid_until = min(valid_until, _as_utc(dep.schedule_end))
+            
+        # Software Check
+        if dep.software:
+            # CHECK IF ALREADY INSTALLED / UNINSTALLED
+            # Use pre-fetched map
+            link = links_map.get(dep.software_id)
+            
+            # If Action is INSTALL
+            if dep.action == "install":
+                # Stop infinite loops: Skip if installed.
+                # For FAILED, we should allow retry after some time (e.g., 1 hour)
+                if link:
+                    if link.status == "installed":
+
+                        installed_ver = link.installed_version
+                        target_ver = dep.software.version
+                        if installed_ver and installed_ver == target_ver:
+                             # Exact same version installed
+                             continue
+                        else:
+                             logger.debug("Update detected for %s. Installed: %s, Target: %s", dep.software.name, installed_ver, target_ver)
+                             # Proceed to install (update)
+                             pass
+                    elif link.status == "failed":
+                        # Retry after 1 hour
+                        retry_at = _as_utc(link.last_updated) + timedelta(hours=1)
+                        if now < retry_at:
+                            valid_until = min(valid_until, retry_at)
+                            continue
+                        # Else, fall through to retry
+            # If Action is UNINSTALL
+            elif dep.action == "uninstall":
+                # If not installed, we can't uninstall (or we assume success)
+                if not link:
+                     continue
+                
+                if link.status in ["installed", "pending"]:
+                     pass # Proceed
+                elif link.status == "failed":
+                     # Retry uninstall after 1 hour similar to install
+                     retry_at = _as_utc(link.last_updated) + timedelta(hours=1)
+                     if now < retry_at:
+                         valid_until = min(valid_until, retry_at)
+                         continue
+                     logger.debug("Retrying uninstall for %s", dep.software.name)
+                else:
+                     # logger.debug("Dep %s skipped. Not installed/failed, can't uninstall.", dep.id)
+                     continue
+
+            download_url = dep.software.download_url
+            if download_url and download_url.startswith("/"):
+                # Construct absolute URL using secure BASE_URL
+
+                base_url = settings.BASE_URL.rstrip("/")
+                download_url = f"{base_url}{download_url}"
+
+            args_to_use = dep.software.silent_args
+            if dep.action == "uninstall":
+                 # Use uninstall args if present, else fallback to silent_args (or empty)
+                 if dep.software.uninstall_args:
+                     args_to_use = dep.software.uninstall_args
+
+            tasks.append(AgentTask(dep.id, dep.action, dep.software.name, download_url, args_to_use, dep.software.is_msi))
+
+    return tasks, valid_until
+
+def _msgspec_body(model):
+    """Dependency decoding the JSON body straight into a msgspec Struct.
+
+    The heartbeat and ack bodies are tiny and arrive constantly; msgspec decodes and validates them
+    in one pass without building a Pydantic model. Lax mode keeps Pydantic's coercions ("3" -> 3).
+    """
+    decoder = msgspec.json.Decoder(model, strict=False)
+
+    async def decode(request: Request):
+        try:
+            return decoder.decode(await request.body())
+        except msgspec.ValidationError as e:
+            raise HTTPException(status_code=422, detail=str(e))
+        except msgspec.DecodeError:
+            raise HTTPException(status_code=422, detail="Invalid JSON body")
+    return decode
+
+class HeartbeatRequest(msgspec.Struct, frozen=True):
+    hostname: Annotated[str, msgspec.Meta(max_length=255)]
+    mac_address: Annotated[str, msgspec.Meta(max_length=17)]
+    os_info: Annotated[str, msgspec.Meta(max_length=100)]
 
 @router.post("/heartbeat")
-def heartbeat(
+async def heartbeat(
     request: Request,
-    data: HeartbeatRequest,
-    session: Session = Depends(get_session)
+    data: HeartbeatRequest = Depends(_msgspec_body(HeartbeatRequest)),
+    session: AsyncSession = Depends(get_async_session)
 ):
     try:
         hostname = data.hostname
@@ -66,7 +473,7 @@ def heartbeat(
         # Global limiters should be outside function, but for simplicity/module scope:
 
         
-        # Cleanup every minute
+        # One timestamp for the whole request: rate limiting, last_seen, schedules and retry windows
         now = datetime.now(timezone.utc)
         
         # Thread Safety for Global Limiters
@@ -94,10 +501,7 @@ def heartbeat(
             heartbeat.rate_limit_store[limit_key] = current_count + 1
         
         # Find or create machine
-        statement = select(Machine).where(Machine.mac_address == mac_address)
-        machine = session.exec(statement).first()
-        
-        from config import settings
+        machine = (await session.exec(MACHINE_BY_MAC, params={"mac_address": mac_address})).first()
         
         # Determine OU Path
         # Determine OU Path
@@ -115,13 +519,16 @@ def heartbeat(
                 ou_path = machine.ou_path
                 
             if should_resolve:
-                from ldap_service import ldap_service
-                ou_path = ldap_service.resolve_machine_ou(hostname, session)
+                ou_path = await ldap_service.aresolve_machine_ou(hostname)
     
+        # Set when the machine list changes (new machine or new hostname) so cached OU trees are rebuilt
+        tree_changed = False
+        # Column values of a machine to register; inserted together with the commit below
+        new_machine = None
         if not machine:
+            tree_changed = True
             # Check if hostname already exists (to prevent Unique Constraint Error)
-            statement_host = select(Machine).where(Machine.hostname == hostname)
-            machine_by_host = session.exec(statement_host).first()
+            machine_by_host = (await session.exec(MACHINE_BY_HOSTNAME, params={"hostname": hostname})).first()
             
 
             # Store creation counts separately
@@ -132,14 +539,14 @@ def heartbeat(
             with _rate_limit_lock:
                 created_count = heartbeat.creation_limit_store.get(client_ip, 0)
                 if created_count > 5: # Max 5 new machines per minute per IP
-                     print(f"DoS Protection: Blocking machine creation from {client_ip}")
+                     logger.warning("DoS Protection: Blocking machine creation from %s", client_ip)
                      raise HTTPException(status_code=429, detail="Registration Rate Limit Exception")
                 heartbeat.creation_limit_store[client_ip] = created_count + 1
             
             if machine_by_host:
                 # Machine exists with different MAC -> Prevent Hijacking unless explicit admin action?
 
-                print(f"Hostname conflict for {hostname} (MAC: {mac_address}). Existing MAC: {machine_by_host.mac_address}")
+                logger.warning("Hostname conflict for %s (MAC: %s). Existing MAC: %s", hostname, mac_address, machine_by_host.mac_address)
                 raise HTTPException(status_code=409, detail="Hostname collision: Hostname already taken by another device.")
                 
                 # Now create with new hostname
@@ -147,20 +554,20 @@ def heartbeat(
                     hostname=hostname, 
                     mac_address=mac_address, 
                     os_info=os_info,
-                    last_seen=datetime.now(timezone.utc),
+                    last_seen=now,
                     ou_path=ou_path
                 )
                 session.add(machine)
             else:
-                # New Machine
-                machine = Machine(
-                    hostname=hostname, 
-                    mac_address=mac_address, 
-                    os_info=os_info,
-                    last_seen=datetime.now(timezone.utc),
-                    ou_path=ou_path
-                )
-                session.add(machine)
+                # New Machine (provisioned with its token right away)
+                new_machine = {
+                    "hostname": hostname,
+                    "mac_address": mac_address,
+                    "os_info": os_info,
+                    "last_seen": now,
+                    "ou_path": ou_path,
+                    "api_key": secrets.token_urlsafe(32),
+                }
         else:
             # Machine found by MAC
             
@@ -170,7 +577,7 @@ def heartbeat(
                 # Handle case where header might be missing or different
                 if not token_header or not secrets.compare_digest(token_header, machine.api_key):
                      # MODIFY: Instead of blocking, we assume re-provisioning if the Global Agent Token was valid (which it is to get here)
-                     print(f"WARNING: Machine Token mismatch for {mac_address}. Re-provisioning new token.")
+                     logger.warning("Machine Token mismatch for %s. Re-provisioning new token.", mac_address)
                      # Generate NEW token
                      machine.api_key = secrets.token_urlsafe(32)
                      session.add(machine)
@@ -179,15 +586,14 @@ def heartbeat(
             machine_by_host = None  # Initialize to avoid NameError
             if machine.hostname != hostname:
                 # Hostname changed. Check if new hostname is already taken.
-                statement_host = select(Machine).where(Machine.hostname == hostname)
-                machine_by_host = session.exec(statement_host).first()
+                machine_by_host = (await session.exec(MACHINE_ID_BY_HOSTNAME, params={"hostname": hostname})).first()
                 
-            if machine_by_host:
+            if machine_by_host is not None:
                     # Hostname collision! 
 
                     suffix = secrets.token_hex(2) 
                     new_hostname = f"{hostname}-dup-{suffix}"
-                    print(f"SECURITY WARNING: Machine {machine.mac_address} tried to change hostname to {hostname}, which is claimed. Renaming to {new_hostname}")
+                    logger.warning("SECURITY WARNING: Machine %s tried to change hostname to %s, which is claimed. Renaming to %s", machine.mac_address, hostname, new_hostname)
                     hostname = new_hostname
                     # Continue with new hostname
                     
@@ -195,7 +601,12 @@ def heartbeat(
                     # session.delete(machine) ...
             
         # Update machine details
-            machine.last_seen = datetime.now(timezone.utc)
+            # Unchanged values below don't dirty the row; with a fresh last_seen there is nothing to UPDATE.
+            # A stale last_seen goes to the batched writer, so a steady heartbeat never writes the row itself.
+            if _last_seen_is_stale(machine.last_seen, now) and not last_seen_writer.record(machine.id, now):
+                machine.last_seen = now
+            if machine.hostname != hostname:
+                tree_changed = True
             machine.hostname = hostname
             machine.os_info = os_info
             # Ip Address Security / IDOR prep
@@ -211,23 +622,28 @@ def heartbeat(
             session.add(machine)
         
         # --- Token Rotation / Provisioning ---
-        if not machine.api_key:
+        if machine is not None and not machine.api_key:
             # Generate new token for this machine
             machine.api_key = secrets.token_urlsafe(32)
             session.add(machine)
-            print(f"DEBUG: Generated new api_key for {machine.hostname}")
+            logger.debug("Generated new api_key for %s", machine.hostname)
         
         try:
-            session.commit()
-            session.refresh(machine)
+            if new_machine is not None:
+                machine = (await session.exec(MACHINE_REGISTER, params=new_machine)).scalars().first()
+                if machine is None:
+                    # The same MAC was registered in the meantime: carry on with that row
+                    machine = (await session.exec(MACHINE_BY_MAC, params={"mac_address": mac_address})).first()
+            await session.commit()
+            if tree_changed:
+                ldap_service.invalidate_tree_cache()
         except Exception as e:
 
 
-            session.rollback()
-            from sqlalchemy.exc import IntegrityError
+            await session.rollback()
             
             if isinstance(e, IntegrityError) or "unique constraint" in str(e).lower():
-                print(f"WARNING: Race condition detected for {hostname} (IntegrityError). Retrying with new hostname...")
+                logger.warning("Race condition detected for %s (IntegrityError). Retrying with new hostname...", hostname)
                 
                 # Retry logic with collision handling
                 # Retry logic with collision handling
@@ -238,7 +654,7 @@ def heartbeat(
                     
                     # 2. Check if conflict was MAC or Hostname
                     # Try to find by MAC again
-                    existing_machine = session.exec(select(Machine).where(Machine.mac_address == mac_address)).first()
+                    existing_machine = (await session.exec(MACHINE_BY_MAC, params={"mac_address": mac_address})).first()
                     
                     if existing_machine:
                          # It was an update collision or someone inserted same MAC
@@ -246,7 +662,7 @@ def heartbeat(
                          # Fix: Do NOT rename the existing valid machine.
                          # Just accept it and update last_seen.
                          # machine.hostname = new_hostname  <-- REMOVED
-                         machine.last_seen = datetime.now(timezone.utc)
+                         machine.last_seen = now
                          machine.ou_path = ou_path
                          # Merge/Add
                          session.add(machine)
@@ -256,7 +672,7 @@ def heartbeat(
                             hostname=new_hostname, # New Name
                             mac_address=mac_address, 
                             os_info=os_info,
-                            last_seen=datetime.now(timezone.utc),
+                            last_seen=now,
                             ou_path=ou_path,
                             api_key=secrets.token_urlsafe(32) # New Token
                         )
@@ -264,354 +680,138 @@ def heartbeat(
 
                         machine = machine_retry
 
-                    session.commit()
-                    session.refresh(machine)
-                    print(f"Recovered from race condition. New hostname: {machine.hostname}")
+                    await session.commit()
+                    logger.warning("Recovered from race condition. New hostname: %s", machine.hostname)
+                    ldap_service.invalidate_tree_cache()
                     
                 except Exception as retry_e:
                      # If it fails again, we give up to avoid infinite loops
-                     print(f"ERROR: Failed to recover from race condition: {retry_e}")
+                     logger.error("Failed to recover from race condition: %s", retry_e)
                      # Try to fetch state one last time? No, just fail.
-                     session.rollback()
+                     await session.rollback()
                      
                      # Final attempt: Just return what's in DB if exists
-                     machine = session.exec(select(Machine).where(Machine.mac_address == mac_address)).first()
+                     machine = (await session.exec(MACHINE_BY_MAC, params={"mac_address": mac_address})).first()
                      if not machine:
                           raise HTTPException(status_code=409, detail="Hostname collision could not be resolved.")
         
         # --- Task Resolution Logic ---
-        current_time = datetime.now(timezone.utc)
-        tasks = []
-        processed_software_ids = set()
-        
-        print(f"DEBUG: Heartbeat for {hostname} (ID: {machine.id}). Checking deployments...")
-    
-        # 1. Get relevant deployments
-        # Optimization: Filter IN SQL
-        
-        # Calculate parent OUs for OU targeting
-        parent_ous = []
-        if machine.ou_path and machine.ou_path != "Unknown":
-
-            from ldap3.utils.dn import parse_dn
-            
-            # parse_dn returns list of (attr, val, sep)
-            # CN=PC1,OU=Sales,DC=example -> [('CN', 'PC1', ','), ('OU', 'Sales', ','), ('DC', 'example', '')]
-            # We want headers.
-            
-            parsed = parse_dn(machine.ou_path)
-            # Skip first RDN (CN=Hostname) if it matches hostname usually?
-            # Existing logic was: "If start with CN=, skip first part"
-            
-            start_idx = 0
-            if parsed and parsed[0][0].upper() == 'CN':
-                 start_idx = 1
-            
-            # Reconstruct parents
-            # Iterating from start_idx to end
-            
-            # Helper to escape DN special characters
-            def escape_dn_chars(s: str) -> str:
-                special_chars = {',': r'\,', '+': r'\+', '"': r'\"', '\\': r'\\', '<': r'\<', '>': r'\>', ';': r'\;'}
-                for char, escaped in special_chars.items():
-                    s = s.replace(char, escaped)
-                return s
-            
-            # Helper to reconstruct DN from parsed slice
-            def reconstruct(p_slice):
-                parts_str = []
-                for attr, val, sep in p_slice:
-                    # We must re-escape value
-                    parts_str.append(f"{attr}={escape_dn_chars(val)}")
-                return ",".join(parts_str)
-            
-            # Create all suffix permutations
-            # e.g. OU=Sales,DC=example and DC=example
-            
-            current_slice = parsed[start_idx:]
-            
-            # Full parent DN
-            if current_slice:
-                 parent_ous.append(reconstruct(current_slice))
-            
-            # Walk up logic (add each parent)
-            # "Simpler: we want all suffixes"
-            # If current_slice is [OU=A, OU=B, DC=C]
-            # We want [OU=A,OU=B,DC=C], [OU=B,DC=C], [DC=C]
-            
-            for i in range(1, len(current_slice)):
-                 suffix = current_slice[i:]
-                 if suffix:
-                      parent_ous.append(reconstruct(suffix))
-                
-            # Old regex loop removed
-            pass
-        
-        # Deployment Target Values we care about:
-        # 1. Machine ID
-        # 2. Hostname
-        # 3. CN=Hostname (prefix)
-        # 4. Any parent OU
-        
-        target_machine_values = [str(machine.id), machine.hostname, f"CN={machine.hostname}"]
-        
-        statement = select(Deployment).options(joinedload(Deployment.software)).where(
-            or_(
-                (Deployment.target_type == "machine") & (Deployment.target_value.in_(target_machine_values)),
-                (Deployment.target_type == "ou") & (Deployment.target_value.in_(parent_ous))
-            )
-        )
-        potential_deployments = session.exec(statement).all()
-        
-        # Sort deployments to prioritize:
-        # 1. By created_at (newest first) - so latest action (install/uninstall) takes precedence
-        # 2. By target_type - Machine (specific) over OU (general)
-        potential_deployments.sort(key=lambda d: (
-            -(d.created_at.timestamp() if d.created_at else 0),  # Newest first
-            0 if d.target_type == "machine" else 1  # Machine first
-        ))
-        
-        print(f"DEBUG: Found {len(potential_deployments)} potential deployments.")
-        
-        from models import MachineSoftwareLink
-    
-        # Fetch all links at once
-        dep_software_ids = [d.software_id for d in potential_deployments]
-        existing_links = session.exec(select(MachineSoftwareLink).where(
-            (MachineSoftwareLink.machine_id == machine.id) &
-            (MachineSoftwareLink.software_id.in_(dep_software_ids))
-        )).all()
-        # Map by software_id
-        links_map = {link.software_id: link for link in existing_links}
-
-        for dep in potential_deployments:
-            # Deduplication: If we already have a task for this software in this batch, skip.
-            if dep.software_id in processed_software_ids:
-                continue
-    
-            is_target = False
-            
-            # Target Check
-            if dep.target_type == "machine":
-                # Check ID Match (strict) OR Hostname Match (loose) OR DN Match (loose)
-                # The backend might store just ID, or DN.
-                if dep.target_value == str(machine.id):
-                    is_target = True
-                elif dep.target_value.lower() == machine.hostname.lower():
-                     is_target = True
-                elif dep.target_value.lower().startswith(f"cn={machine.hostname}".lower()):
-                     # Check if it is exact match or comma follows (to avoid prefix matching like PC1 matching PC10)
-                     val = dep.target_value.lower()
-                     prefix = f"cn={machine.hostname}".lower()
-                     if val == prefix or val.startswith(prefix + ","):
-                         is_target = True
-                     
-                # Robust OU matching
-                if machine.ou_path and dep.target_value:
-                    machine_dn = machine.ou_path.lower()
-                    target_dn = dep.target_value.lower()
-                    
-
-                    # e.g. target="cn=computers,dc=local" and machine="cn=pc1,cn=computers,dc=local"
-                    if machine_dn.endswith(target_dn):
-                         # Ensure boundary correctness (comma or exact match)
-                        if machine_dn == target_dn or machine_dn.endswith("," + target_dn):
-                            is_target = True
-            
-            if not is_target:
-                # print(f"DEBUG: Dep {dep.id} skipped. Not target. (Type: {dep.target_type}, Val: {dep.target_value})")
-                continue
-    
-            # Schedule Check
-            if dep.schedule_start and current_time < dep.schedule_start:
-                print(f"DEBUG: Dep {dep.id} skipped. Schedule start future.")
-                continue
-            if dep.schedule_end and current_time > dep.schedule_end:
-                print(f"DEBUG: Dep {dep.id} skipped. Schedule end passed.")
-                continue
-                
-            # Software Check
-            if dep.software:
-                # CHECK IF ALREADY INSTALLED / UNINSTALLED
-                # Use pre-fetched map
-                link = links_map.get(dep.software_id)
-                
-                # If Action is INSTALL
-                if dep.action == "install":
-                    # Stop infinite loops: Skip if installed.
-                    # For FAILED, we should allow retry after some time (e.g., 1 hour)
-                    if link:
-                        if link.status == "installed":
-
-                            installed_ver = link.installed_version
-                            target_ver = dep.software.version
-                            if installed_ver and installed_ver == target_ver:
-                                 # Exact same version installed
-                                 continue
-                            else:
-                                 print(f"DEBUG: Update detected for {dep.software.name}. Installed: {installed_ver}, Target: {target_ver}")
-                                 # Proceed to install (update)
-                                 pass
-                        elif link.status == "failed":
-                            # Retry after 1 hour
-                            if datetime.now(timezone.utc) - link.last_updated < timedelta(hours=1):
-                                continue
-                            # Else, fall through to retry
-                # If Action is UNINSTALL
-                elif dep.action == "uninstall":
-                    # If not installed, we can't uninstall (or we assume success)
-                    if not link:
-                         continue
-                    
-                    if link.status in ["installed", "pending"]:
-                         pass # Proceed
-                    elif link.status == "failed":
-                         # Retry uninstall after 1 hour similar to install
-                         if datetime.now(timezone.utc) - link.last_updated < timedelta(hours=1):
-                             continue
-                         print(f"DEBUG: Retrying uninstall for {dep.software.name}")
-                    else:
-                         # print(f"DEBUG: Dep {dep.id} skipped. Not installed/failed, can't uninstall.")
-                         continue
-
-                download_url = dep.software.download_url
-                if download_url and download_url.startswith("/"):
-                    # Construct absolute URL using secure BASE_URL
-
-                    base_url = settings.BASE_URL.rstrip("/")
-                    download_url = f"{base_url}{download_url}"
-
-                args_to_use = dep.software.silent_args
-                if dep.action == "uninstall":
-                     # Use uninstall args if present, else fallback to silent_args (or empty)
-                     if dep.software.uninstall_args:
-                         args_to_use = dep.software.uninstall_args
-
-                tasks.append({
-                    "id": dep.id,
-                    "type": dep.action, # install or uninstall
-                    "software_name": dep.software.name,
-                    "download_url": download_url,
-                    "silent_args": args_to_use,
-                    "is_msi": dep.software.is_msi
-                })
-                processed_software_ids.add(dep.software_id)
-                
-        print(f"DEBUG: Returning {len(tasks)} tasks.")
-        return {"status": "ok", "tasks": tasks, "machine_token": machine.api_key}
+        # An ack still queued would otherwise have the task sent again
+        if ack_writer.has_pending(machine.id):
+            await ack_writer.flush()
+
+        # 1. Get relevant deployments (cached until a deployment, software or link row changes)
+        potential_deployments, links_map = await _get_deployment_candidates(session, machine)
+
+        # 2. Reuse the task list from the last heartbeat while nothing it depends on has changed
+        with _deployment_cache_lock:
+            memo = _task_cache.get(machine.id)
+        if memo is not None and memo[0] is potential_deployments and now < memo[1]:
+            tasks = memo[2]
+        else:
+            tasks, valid_until = _resolve_tasks(machine, potential_deployments, links_map, now)
+            with _deployment_cache_lock:
+                _task_cache[machine.id] = (potential_deployments, valid_until, tasks)
+
+        # One trace line per heartbeat, and only a flag check when DEBUG is off
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Heartbeat for %s (ID: %s): %d potential deployments, returning %d tasks.",
+                         hostname, machine.id, len(potential_deployments), len(tasks))
+        # Returned as a response object so FastAPI skips its jsonable_encoder pass over the tasks
+        return ORJSONResponse({"status": "ok", "tasks": tasks, "machine_token": machine.api_key})
     except Exception as e:
         if isinstance(e, HTTPException):
             raise e
-        import traceback
-        error_msg = f"ERROR: Heartbeat failed for {data.hostname}: {e}\n{traceback.format_exc()}"
-        print(error_msg)
-        # LOG TO STDOUT ONLY
-        pass
+        logger.exception("Heartbeat failed for %s: %s", data.hostname, e)
         raise HTTPException(status_code=500, detail=f"Internal Server Error: {str(e)}")
 
-class AckRequest(BaseModel):
+class AckRequest(msgspec.Struct, frozen=True):
     task_id: int
     status: str # success, failed
-    message: str = ""
     mac_address: str
+    message: str = ""
 
 @router.post("/ack")
-def acknowledge_task(
-    data: AckRequest,
+async def acknowledge_task(
     request: Request,
-    session: Session = Depends(get_session)
+    data: AckRequest = Depends(_msgspec_body(AckRequest)),
+    session: AsyncSession = Depends(get_async_session)
 ):
     mac_address = data.mac_address.strip().lower().replace("-", ":")
+    now = datetime.now(timezone.utc)
 
     # Security: Verify Machine Token if exists
     token_header = request.headers.get("X-Machine-Token")
     # task_id is the deployment_id
-    deployment = session.get(Deployment, data.task_id)
+    # Software is joined into the same SELECT; an async session can't lazy-load it later
+    deployment = await session.get(Deployment, data.task_id, options=[joinedload(Deployment.software)])
     if not deployment:
         raise HTTPException(status_code=404, detail="Deployment not found")
     
     # Find Machine
-    statement = select(Machine).where(Machine.mac_address == mac_address)
-    machine = session.exec(statement).first()
+    machine = await _get_machine_identity(session, mac_address)
     if not machine:
         raise HTTPException(status_code=404, detail="Machine not found")
         
     if machine.api_key:
         if not token_header or not secrets.compare_digest(token_header, machine.api_key):
-             print(f"SECURITY WARNING: Invalid Machine Token for {mac_address}. Token mismatch.")
+             logger.warning("SECURITY WARNING: Invalid Machine Token for %s. Token mismatch.", mac_address)
              raise HTTPException(status_code=403, detail="Invalid Machine Token")
     else:
         # This prevents spooling attacks on unprovisioned machines.
-        print(f"SECURITY WARNING: Ack received for machine {mac_address} without API Key.")
+        logger.warning("SECURITY WARNING: Ack received for machine %s without API Key.", mac_address)
         raise HTTPException(status_code=403, detail="Machine not provisioned (No API Key)")
 
 
     # Check if deployment actually belongs to this machine
     is_valid_target = False
+    target_value_lower = deployment.target_value.lower()
     if deployment.target_type == "machine":
         # ID or Hostname Check
+        hostname_lower = machine.hostname.lower()
         if deployment.target_value == str(machine.id):
              is_valid_target = True
-        elif deployment.target_value.lower() == machine.hostname.lower():
+        elif target_value_lower == hostname_lower:
              is_valid_target = True
-        elif deployment.target_value.lower().startswith(f"cn={machine.hostname}".lower()):
+        elif target_value_lower.startswith(f"cn={hostname_lower}"):
              # Basic loose check, similar to agent logic
              is_valid_target = True
     elif deployment.target_type == "ou":
         # Check if machine matches OU logic
         if machine.ou_path:
-             # Logic from heartbeat, simplified:
-             # Does machine.ou_path end with deployment target value?
-             m_dn = machine.ou_path.lower()
-             t_dn = deployment.target_value.lower()
-             if m_dn.endswith(t_dn):
-                 if m_dn == t_dn or m_dn.endswith("," + t_dn):
-                     is_valid_target = True
+             # Same rule as heartbeat: the target is the machine's DN or one of its parents
+             if target_value_lower in _ou_match_set(machine.ou_path):
+                 is_valid_target = True
 
     if not is_valid_target:
-         print(f"SECURITY ALERT: Machine {machine.hostname} tried to ACK deployment {deployment.id} which targets {deployment.target_value} ({deployment.target_type})")
+         logger.warning("SECURITY ALERT: Machine %s tried to ACK deployment %s which targets %s (%s)", machine.hostname, deployment.id, deployment.target_value, deployment.target_type)
          raise HTTPException(status_code=403, detail="Deployment does not target this machine")
 
     # Update or Create Link
-    from models import MachineSoftwareLink
-    
-    link = session.exec(select(MachineSoftwareLink).where(
-        (MachineSoftwareLink.machine_id == machine.id) &
-        (MachineSoftwareLink.software_id == deployment.software_id)
-    )).first()
-    
-    if not link:
-        try:
-             # Double check inside potential lock if we had one, but strict DB constraint is better.
-             # Since we can't change schema easily, we'll try/except
-             link = MachineSoftwareLink(
-                machine_id=machine.id,
-                software_id=deployment.software_id,
-                status="pending"
-             )
-             session.add(link)
-             session.flush() # Force insert to check constraint
-        except Exception: # Handling IntegrityError
-             session.rollback()
-             # Re-fetch
-             link = session.exec(select(MachineSoftwareLink).where(
-                (MachineSoftwareLink.machine_id == machine.id) &
-                (MachineSoftwareLink.software_id == deployment.software_id)
-             )).first()
-    
+    installed_version = None
     if data.status == "success":
         if deployment.action == "uninstall":
-            link.status = "uninstalled" # or delete the link? Keeping it as history is better.
+            status = "uninstalled" # or delete the link? Keeping it as history is better.
         else:
-            link.status = "installed"
+            status = "installed"
             if deployment.software:
-                link.installed_version = deployment.software.version
+                installed_version = deployment.software.version
     else:
-        link.status = "failed"
-        
-    link.last_updated = datetime.now(timezone.utc)
-    session.add(link)
-    session.commit()
+        status = "failed"
+
+    # Batched with other acks; the next heartbeat of this machine waits for it to be written
+    if not ack_writer.record(machine.id, deployment.software_id, status, installed_version, now):
+        # Single upsert: concurrent acks for the same link can't hit the primary key
+        await session.exec(LINK_UPSERT, params={
+            "machine_id": machine.id,
+            "software_id": deployment.software_id,
+            "status": status,
+            "installed_version": installed_version,
+            "last_updated": now,
+        })
+        # Core statements don't go through the flush hooks; the cached heartbeat candidates hold this link
+        session.info.setdefault("links_changed", set()).add(machine.id)
+        await session.commit()
     
     return {"status": "acknowledged"}
 
@@ -622,12 +822,13 @@ class LogRequest(BaseModel):
     message: str = Field(..., max_length=2000)
 
 @router.post("/log")
-def log_agent_event(
+async def log_agent_event(
     request: Request,
     data: LogRequest,
-    session: Session = Depends(get_session)
+    session: AsyncSession = Depends(get_async_session)
 ):
     mac_address = data.mac_address.strip().lower().replace("-", ":")
+    now = datetime.now(timezone.utc)
 
     # Validate log level
     valid_levels = {"INFO", "WARN", "ERROR"}
@@ -637,8 +838,7 @@ def log_agent_event(
         # level = "INFO" 
         raise HTTPException(status_code=400, detail=f"Invalid log level. Must be one of {valid_levels}")
     
-    statement = select(Machine).where(Machine.mac_address == mac_address)
-    machine = session.exec(statement).first()
+    machine = await _get_machine_identity(session, mac_address)
     
     if machine:
         # IDOR Security Check
@@ -648,26 +848,23 @@ def log_agent_event(
 
         if machine.ip_address and current_ip:
             if machine.ip_address != current_ip:
-                print(f"SECURITY ALERT: Log attempt for {mac_address} from unauthorized IP {current_ip} (Expected {machine.ip_address}). Blocking.")
+                logger.warning("SECURITY ALERT: Log attempt for %s from unauthorized IP %s (Expected %s). Blocking.", mac_address, current_ip, machine.ip_address)
 
                 raise HTTPException(status_code=403, detail="IP Address Mismatch")
         
 
         # Limit logs to 60 per minute per machine
-        from sqlalchemy import func
-        cutoff = datetime.now(timezone.utc) - timedelta(minutes=1)
+        cutoff = now - timedelta(minutes=1)
         
         # Optimized Count Query
-        statement = select(func.count()).where(
-            (AgentLog.machine_id == machine.id) & 
-            (AgentLog.timestamp > cutoff)
-        )
-        log_count_res = session.exec(statement).first()
+        log_count_res = (await session.exec(RECENT_LOG_COUNT, params={"machine_id": machine.id, "cutoff": cutoff})).first()
         # Extract scalar
         log_count = log_count_res if isinstance(log_count_res, int) else log_count_res[0] if log_count_res else 0
+        # Lines still waiting in the write queue count too
+        log_count += log_queue.pending_count(machine.id)
         
         if log_count >= 60:
-            print(f"Rate Limit Exceeded for {machine.hostname}")
+            logger.warning("Rate Limit Exceeded for %s", machine.hostname)
             raise HTTPException(status_code=429, detail="Rate limit exceeded")
 
         # Security: Verify Machine Token
@@ -675,14 +872,20 @@ def log_agent_event(
         
 
         if not machine.api_key:
-             print(f"SECURITY WARNING: Log attempt for {mac_address} which is not provisioned (No API Key).")
+             logger.warning("SECURITY WARNING: Log attempt for %s which is not provisioned (No API Key).", mac_address)
              raise HTTPException(status_code=403, detail="Machine not provisioned")
 
         if not token_header or not secrets.compare_digest(token_header, machine.api_key):
-             print(f"SECURITY WARNING: Invalid Machine Token for log from {mac_address}")
+             logger.warning("SECURITY WARNING: Invalid Machine Token for log from %s", mac_address)
              raise HTTPException(status_code=403, detail="Invalid Machine Token")
                  
-        log = AgentLog(machine_id=machine.id, level=level, message=data.message)
-        session.add(log)
-        session.commit()
+        row = {"machine_id": machine.id, "timestamp": now, "level": level, "message": data.message}
+        try:
+            queued = log_queue.enqueue(row)
+        except asyncio.QueueFull:
+            raise HTTPException(status_code=503, detail="Log queue full")
+        if not queued:
+            # No background writer (app started without its lifespan): write the line directly
+            session.add(AgentLog(**row))
+            await session.commit()
     return {"status": "logged"}
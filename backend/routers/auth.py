@@ -1,11 +1,10 @@
 from fastapi import APIRouter, Depends, HTTPException, status
 from fastapi.concurrency import run_in_threadpool
 from fastapi.security import OAuth2PasswordRequestForm
-from sqlmodel import Session, select
-from datetime import timedelta
+from sqlmodel import Session
 from database import get_session
 from models import Admin
-from auth import create_access_token, ACCESS_TOKEN_EXPIRE_MINUTES, get_password_hash, verify_password
+from auth import ADMIN_BY_USERNAME, create_access_token, get_password_hash, get_dummy_password_hash, verify_password, invalidate_admin_cache
 from config import settings
 from ldap_service import ldap_service
 
@@ -23,13 +22,12 @@ async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends(
     # 2. Try LDAP Auth
     # 2. Try LDAP Auth
 
-    ldap_status = ldap_service.verify_user(form_data.username, form_data.password)
+    ldap_status = await ldap_service.averify_user(form_data.username, form_data.password)
     
     if ldap_status == "SUCCESS":
         # If LDAP auth succeeds, we ensure the user exists in our local admin table (cache)
         # so they can have a role, etc.
-        statement = select(Admin).where(Admin.username == form_data.username)
-        user = session.exec(statement).first()
+        user = session.exec(ADMIN_BY_USERNAME, params={"username": form_data.username}).first()
         if not user:
             # Auto-provision LDAP user as admin
             # Race condition fix: Handle concurrent creation
@@ -44,23 +42,21 @@ async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends(
                 session.add(user)
                 session.commit()
                 session.refresh(user)
+                invalidate_admin_cache(user.username)
             except IntegrityError:
                 session.rollback()
                 # User was created concurrently, fetch it
-                statement = select(Admin).where(Admin.username == form_data.username)
-                user = session.exec(statement).first()
+                user = session.exec(ADMIN_BY_USERNAME, params={"username": form_data.username}).first()
                 # Update password if needed (optional here, but safe)
         else:
             # Update cached password just in case
             user.hashed_password = await run_in_threadpool(get_password_hash, form_data.password)
             session.add(user)
             session.commit()
+            invalidate_admin_cache(user.username)
             
         # Proceed to token generation
-        access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
-        access_token = create_access_token(
-            data={"sub": user.username}, expires_delta=access_token_expires
-        )
+        access_token = create_access_token(sub=user.username)
         return {"access_token": access_token, "token_type": "bearer"}
     elif ldap_status == "INVALID_CREDENTIALS":
 
@@ -75,8 +71,7 @@ async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends(
     # And allows cached login if AD is down (ERROR).
     
     # 3. DB Auth (Fallback/Cache)
-    statement = select(Admin).where(Admin.username == form_data.username)
-    user = session.exec(statement).first()
+    user = session.exec(ADMIN_BY_USERNAME, params={"username": form_data.username}).first()
     
     # Mock Auth for Prototype if user exists (or if we just created 'admin')
 
@@ -84,11 +79,8 @@ async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends(
 
     if not user:
         # Dummy verification to consume same time
-        # Use a consistent dummy hash to avoid recalculating it every time, but generated securely or standard
-        # For simplicity and security, we can use a fixed valid hash derived from a constant if needed, 
-        # but recalculating a hash on startup is better. 
-        # Here we use a safe fallback.
-        dummy_hash = "$2b$12$EixZaYVK1fsbw1ZfbX3OXePaWrn96pzwLO3.wS5x0.k.F.eZ./W." # Keep structure but acknowledge it's dummy
+        # The dummy hash uses the configured bcrypt cost so timing matches real users
+        dummy_hash = await run_in_threadpool(get_dummy_password_hash)
         await run_in_threadpool(verify_password, form_data.password, dummy_hash)
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
@@ -110,8 +102,5 @@ async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends(
             headers={"WWW-Authenticate": "Bearer"},
         )
 
-    access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
-    access_token = create_access_token(
-        data={"sub": user.username}, expires_delta=access_token_expires
-    )
+    access_token = create_access_token(sub=user.username)
     return {"access_token": access_token, "token_type": "bearer"}
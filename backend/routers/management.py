@@ -11,6 +11,10 @@ from ldap_service import ldap_service
 
 router = APIRouter(prefix="/api/v1/management", tags=["management"], dependencies=[Depends(get_current_admin)])
 
+# Compiled once at import rather than looked up in re's cache on every call
+_UNESCAPED_COMMA = re.compile(r'(?<!\\\\),')
+_UNSAFE_FILENAME_CHARS = re.compile(r'[^a-zA-Z0-9._-]')
+
 @router.get("/software", response_model=List[Software])
 def get_software(offset: int = 0, limit: int = 100, session: Session = Depends(get_session)):
     return session.exec(select(Software).offset(offset).limit(limit)).all()
@@ -195,6 +199,7 @@ def delete_machine(machine_id: int, session: Session = Depends(get_session), adm
     # Delete the machine
     session.delete(machine)
     session.commit()
+    ldap_service.invalidate_tree_cache()
     
     return {"status": "deleted", "id": machine_id, "hostname": hostname}
 
@@ -289,13 +294,17 @@ def get_deployments(session: Session = Depends(get_session)):
     
     # 2. Gather targets to resolve status
     machine_targets = set()
+    machine_software_ids = set()
     for dep in all_deployments:
         if dep.target_type == "machine":
             machine_targets.add(dep.target_value)
+            machine_software_ids.add(dep.software_id)
             
     # 3. Resolve targets to Machine IDs
     # Map target_value -> machine_id
     target_map = {}
+    # Hostnames for display, filled from the same rows
+    id_to_hostname = {}
     if machine_targets:
         # Check for IDs
         numeric_ids = {int(t) for t in machine_targets if t.isdigit()}
@@ -307,6 +316,7 @@ def get_deployments(session: Session = Depends(get_session)):
             ms = session.exec(select(Machine).where(Machine.id.in_(numeric_ids))).all()
             for m in ms:
                 target_map[str(m.id)] = m.id
+                id_to_hostname[m.id] = m.hostname
         
         # Query 2: By Hostname (or CN=...)
         # Simplifying assumption: target_value is hostname or CN=hostname
@@ -325,6 +335,7 @@ def get_deployments(session: Session = Depends(get_session)):
             
             ms = session.exec(select(Machine).where(Machine.hostname.in_(clean_hosts))).all()
             for m in ms:
+                id_to_hostname[m.id] = m.hostname
                 h_clean = m.hostname.lower()
                 # Find which original target this matches
                 # If target was "TP-IT01", matches. If "CN=TP-IT01", matches.
@@ -351,8 +362,11 @@ def get_deployments(session: Session = Depends(get_session)):
         # We also care about the software IDs in deployments
         # But fetching all links for these machines is probably okay (hundreds not millions)
         # Better: Filter by software too?
-        # Let's just fetch links for these machines.
-        l_stmt = select(MachineSoftwareLink).where(MachineSoftwareLink.machine_id.in_(resolved_machine_ids))
+        # Only the links a machine deployment can be hidden by: these machines x the deployed software
+        l_stmt = select(MachineSoftwareLink).where(
+            MachineSoftwareLink.machine_id.in_(resolved_machine_ids) &
+            MachineSoftwareLink.software_id.in_(machine_software_ids)
+        )
         links = session.exec(l_stmt).all()
         for l in links:
             links_map[(l.machine_id, l.software_id)] = l.status
@@ -384,22 +398,7 @@ def get_deployments(session: Session = Depends(get_session)):
                 result.append(dep)
                 
     # 6. Resolve Hostnames for display
-    # We want to show "tp-it01" instead of "2"
-    # We have target_map mapping "2" -> 2 (int ID)
-    # query machines
-    
-    machine_ids = set()
-    for dep in result:
-        if dep.target_type == "machine":
-            # get resolved ID
-            mid = target_map.get(dep.target_value)
-            if mid: machine_ids.add(mid)
-            
-    id_to_hostname = {}
-    if machine_ids:
-        ms = session.exec(select(Machine).where(Machine.id.in_(machine_ids))).all()
-        for m in ms:
-            id_to_hostname[m.id] = m.hostname
+    # We want to show "tp-it01" instead of "2"; id_to_hostname was filled while resolving targets in step 3
             
     # Format Result
     final_output = []
@@ -454,7 +453,10 @@ def clear_all_deployments(session: Session = Depends(get_session), admin: Admin
 def delete_deployment(deployment_id: int, session: Session = Depends(get_session), admin: Admin = Depends(get_current_admin)):
     """Delete a single deployment / cancel a pending task."""
     
-    deployment = session.get(Deployment, deployment_id)
+    from sqlalchemy.orm import joinedload
+
+    # The software name for the audit entry comes back in the same SELECT
+    deployment = session.get(Deployment, deployment_id, options=[joinedload(Deployment.software)])
     if not deployment:
         raise HTTPException(status_code=404, detail="Deployment not found")
     
@@ -518,7 +520,7 @@ def create_bulk_deployment(request: BulkDeploymentRequest, session: Session = De
              target_ids.append(int(dn_clean))
         elif dn_u.startswith("CN="):
              # Parse hostname
-             parts = re.split(r'(?<!\\\\),', dn_clean)
+             parts = _UNESCAPED_COMMA.split(dn_clean)
              if parts:
                  kv = parts[0].split("=", 1)
                  if len(kv) == 2:
@@ -548,8 +550,15 @@ def create_bulk_deployment(request: BulkDeploymentRequest, session: Session = De
     for ou in target_ous:
         # Recursive suffix match
         ms = session.exec(select(Machine).where(Machine.ou_path.endswith(ou))).all()
+        # The OU itself, or a DN ending in ",<ou>"; the boundary is checked by index, not by building ","+ou
+        ou_len = len(ou)
         for m in ms:
-             if m.ou_path == ou or m.ou_path.endswith("," + ou):
+             path_len = len(m.ou_path)
+             if path_len == ou_len:
+                  is_match = m.ou_path == ou
+             else:
+                  is_match = path_len > ou_len and m.ou_path[path_len - ou_len - 1] == "," and m.ou_path.endswith(ou)
+             if is_match:
                   machines_dict[m.id] = m
                   
     # Create Deployments
@@ -669,7 +678,6 @@ def create_bulk_deployment(request: BulkDeploymentRequest, session: Session = De
 async def upload_file(file: UploadFile = File(...), session: Session = Depends(get_session)):
     import shutil
     import os
-    import re
     
     UPLOAD_DIR = "uploads"
     os.makedirs(UPLOAD_DIR, exist_ok=True)
@@ -678,7 +686,7 @@ async def upload_file(file: UploadFile = File(...), session: Session = Depends(g
     # 1. Use basename to strip any directory components
     filename = os.path.basename(file.filename)
     # 2. Remove any non-alphanumeric characters except . _ - to be extra safe
-    filename = re.sub(r'[^a-zA-Z0-9._-]', '', filename)
+    filename = _UNSAFE_FILENAME_CHARS.sub('', filename)
     
     if not filename or filename.startswith('.'):
         raise HTTPException(status_code=400, detail="Invalid filename (Hidden files not allowed)")
@@ -1,11 +1,9 @@
-from sqlmodel import Session, select, create_engine
+from sqlmodel import select
 from models import Software, Machine
-from database import sqlite_url
-
-engine = create_engine(sqlite_url)
+from database import session_scope
 
 def seed_now():
-    with Session(engine) as session:
+    with session_scope() as session:
         if not session.exec(select(Software)).first():
             print("Seeding Mock Software...")
             softwares = [